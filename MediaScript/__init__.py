@@ -1,2 +1,3 @@
 from .parser.parse import parse
-from .parser.parse import commandlength
\ No newline at end of file
+from .parser.parse import commandlength
+from .parser.session import Session
\ No newline at end of file
@@ -0,0 +1,3 @@
+from .blobstore import BlobStore
+from .coordinator import Coordinator, DistributedError, spawn_local_workers, stop_local_workers
+from .plan import compile_plan
\ No newline at end of file
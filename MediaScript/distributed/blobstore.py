@@ -0,0 +1,168 @@
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import uuid
+
+# Blob ids are <sha256>[.ext]. The extension is kept so FFmpeg can pick the
+# output format of files derived from the blob.
+BLOB_ID = re.compile(r"[0-9a-f]{64}(?:\.[A-Za-z0-9]+)?")
+# Blob references in scripts: blob:<id>
+BLOB_REFERENCE = re.compile(f"blob:({BLOB_ID.pattern})")
+
+def is_blob_id(blob_id) -> bool:
+    """Whether a value is a well-formed blob id, and so safe to use as a file name."""
+    return isinstance(blob_id, str) and BLOB_ID.fullmatch(blob_id) is not None
+
+def file_digest(path: str) -> str:
+    """Returns the SHA-256 of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class BlobStore:
+    """
+    A content-addressed directory of files.
+
+    Every blob is named by the SHA-256 of its contents plus the extension of the
+    file it came from, so the same content stored twice is kept once.
+    """
+    def __init__(self, root: str = None):
+        """
+        :param root: The directory holding the blobs, a new temporary one when not given.
+        :type root: str
+        """
+        self.owned = root is None
+        self.root = root or tempfile.mkdtemp(prefix="mediascript_blobs_")
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, blob_id: str) -> str:
+        """
+        Returns the path of a blob.
+
+        :raises ValueError: If the id is not a blob id.
+        """
+        if not is_blob_id(blob_id):
+            raise ValueError(f"Invalid blob id {blob_id!r}")
+        return os.path.join(self.root, blob_id)
+
+    def has(self, blob_id: str) -> bool:
+        """Whether the store holds a blob."""
+        return os.path.exists(self.path(blob_id))
+
+    def size(self, blob_id: str) -> int:
+        """Returns the size of a blob in bytes."""
+        return os.path.getsize(self.path(blob_id))
+
+    def ids(self) -> list:
+        """Returns every blob in the store."""
+        return [entry for entry in os.listdir(self.root) if not entry.startswith(".")]
+
+    def put(self, path: str, move: bool = False) -> str:
+        """
+        Adds a file to the store.
+
+        Files the store does not own are copied, never linked, so editing the
+        original later cannot change a blob under its id. The id is computed
+        from the store's own copy.
+
+        :param path: The file.
+        :type path: str
+        :param move: Whether the file belongs to the caller and can be moved into the store.
+        :type move: bool
+        :return: The blob id.
+        :rtype: str
+        """
+        incoming = self.incoming()
+        if move:
+            try:
+                os.replace(path, incoming)
+            except OSError:
+                shutil.move(path, incoming)
+        else:
+            shutil.copyfile(path, incoming)
+        blob_id = file_digest(incoming) + os.path.splitext(path)[1].lower()
+        if self.has(blob_id):
+            os.remove(incoming)
+            self.touch(blob_id)
+        else:
+            os.replace(incoming, self.path(blob_id))
+        return blob_id
+
+    def incoming(self) -> str:
+        """Returns a temporary path in the store to receive a blob into."""
+        return os.path.join(self.root, f".incoming_{uuid.uuid4().hex}")
+
+    def commit(self, incoming: str, blob_id: str):
+        """
+        Adds a received file to the store after checking its contents match its id.
+
+        :param incoming: The path returned by ``incoming``.
+        :type incoming: str
+        :param blob_id: The expected blob id.
+        :type blob_id: str
+        :raises ValueError: If the contents do not match.
+        """
+        if file_digest(incoming) != blob_id[:64]:
+            os.remove(incoming)
+            raise ValueError(f"Blob {blob_id} does not match its contents.")
+        os.replace(incoming, self.path(blob_id))
+
+    def resolve(self, script: str) -> str:
+        """
+        Replaces the blob references of a script with paths in the store.
+
+        :raises KeyError: If a referenced blob is missing.
+        """
+        def replace(match):
+            if not self.has(match.group(1)):
+                raise KeyError(match.group(1))
+            self.touch(match.group(1))
+            return self.path(match.group(1))
+        return BLOB_REFERENCE.sub(replace, script)
+
+    def touch(self, blob_id: str):
+        """Marks a blob as used, eviction removes the least recently used blobs first."""
+        try:
+            os.utime(self.path(blob_id))
+        except OSError:
+            pass
+
+    def evict(self, max_bytes: int, keep=()):
+        """
+        Removes the least recently used blobs until the store fits in max_bytes.
+
+        :param max_bytes: The size the store may use.
+        :type max_bytes: int
+        :param keep: Blobs that must stay, like the inputs and outputs of running scripts.
+        :type keep: iterable
+        """
+        blobs = []
+        for blob_id in self.ids():
+            try:
+                stat = os.stat(self.path(blob_id))
+            except (OSError, ValueError):
+                continue
+            blobs.append((stat.st_mtime, stat.st_size, blob_id))
+        total = sum(size for _, size, _ in blobs)
+        for _, size, blob_id in sorted(blobs):
+            if total <= max_bytes:
+                break
+            if blob_id in keep:
+                continue
+            try:
+                os.remove(self.path(blob_id))
+                total -= size
+            except OSError:
+                pass
+
+    def close(self):
+        """Removes the store if it is a temporary one."""
+        if self.owned:
+            shutil.rmtree(self.root, ignore_errors=True)
@@ -0,0 +1,270 @@
+import asyncio
+import os
+import sys
+import time
+from .blobstore import BLOB_REFERENCE, BlobStore, is_blob_id
+from .plan import compile_plan
+from .protocol import RemoteError, request
+
+class DistributedError(Exception):
+    """Exception raised when a step cannot run on any worker."""
+    pass
+
+class Coordinator:
+    """
+    Compiles scripts to plans and runs their steps on worker nodes.
+
+    Local files read by ``loadfile`` are added to the coordinator's blob store.
+    Every step goes to the healthy worker already holding the most bytes of its
+    inputs, the least busy one on a tie, and missing inputs are copied to it
+    from the coordinator or from the worker holding them. A step that fails on
+    a node is retried on another one.
+    """
+    def __init__(self, workers: list, store: BlobStore = None, retries: int = 2, health_interval: float = 5.0, timeout: float = 30.0, token: str = None):
+        """
+        :param workers: The (host, port) of each worker.
+        :type workers: list
+        :param store: The coordinator's blob store, a temporary one when not given.
+        :type store: BlobStore
+        :param retries: How many other workers to try when a step fails on a node.
+        :type retries: int
+        :param health_interval: Seconds between health checks.
+        :type health_interval: float
+        :param timeout: Seconds to wait for a worker to answer anything but a run.
+        :type timeout: float
+        :param token: The shared secret of the workers, MEDIASCRIPT_TOKEN when not given.
+        :type token: str
+        """
+        # A store the coordinator creates is temporary and removed on close
+        self._owns_store = store is None
+        self.store = store or BlobStore()
+        self.token = token or os.environ.get("MEDIASCRIPT_TOKEN")
+        self.retries = retries
+        self.health_interval = health_interval
+        self.timeout = timeout
+        self.workers = {tuple(address): {"healthy": False, "active": 0, "slots": 1} for address in workers}
+        # Workers holding each blob, and blob sizes, for scheduling
+        self.locations = {}
+        self.sizes = {}
+        self._health_task = None
+
+    async def start(self):
+        """Checks every worker once, then keeps checking them in the background."""
+        await self.check_health()
+        self._health_task = asyncio.create_task(self._health_loop())
+
+    async def close(self):
+        """Stops the health checks and removes the temporary blob store."""
+        if self._health_task:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except asyncio.CancelledError:
+                pass
+            self._health_task = None
+        if self._owns_store:
+            self.store.close()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await self.check_health()
+
+    async def check_health(self):
+        """Asks every worker whether it is up and how busy it is."""
+        async def check(address):
+            try:
+                response, _ = await request(address, {"op": "health"}, timeout=self.timeout, token=self.token)
+                self.workers[address].update(healthy=True, slots=response["slots"], active=response["active"])
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, RemoteError):
+                self.mark_down(address)
+        await asyncio.gather(*(check(address) for address in self.workers))
+
+    def mark_down(self, address: tuple):
+        """Stops scheduling on a worker and forgets the blobs it held."""
+        self.workers[address]["healthy"] = False
+        for holders in self.locations.values():
+            holders.discard(address)
+
+    def choose(self, blobs: list, exclude: set = ()) -> tuple:
+        """
+        Picks the worker for a step.
+
+        :param blobs: The blobs the step reads.
+        :type blobs: list
+        :param exclude: Workers the step already failed on.
+        :type exclude: set
+        :return: The worker address, None when no worker is available.
+        :rtype: tuple
+        """
+        candidates = [address for address, state in self.workers.items() if state["healthy"] and address not in exclude]
+        if not candidates:
+            return None
+        def score(address):
+            local = sum(self.sizes.get(blob, 0) for blob in blobs if address in self.locations.get(blob, ()))
+            state = self.workers[address]
+            return (local, -state["active"] / state["slots"])
+        return max(candidates, key=score)
+
+    async def upload(self, script: str) -> str:
+        """
+        Adds the local files a script loads to the store.
+
+        :param script: The script.
+        :type script: str
+        :return: The script with ``loadfile`` paths replaced by blob references.
+        :rtype: str
+        """
+        lines = []
+        for line in script.splitlines():
+            parts = line.split(maxsplit=2)
+            if len(parts) > 1 and parts[0] == "loadfile" and not parts[1].startswith(("blob:", "branch:")):
+                blob = await asyncio.to_thread(self.store.put, os.path.abspath(parts[1]))
+                self.sizes[blob] = self.store.size(blob)
+                name = parts[2] if len(parts) > 2 else os.path.basename(parts[1])
+                line = f"loadfile blob:{blob} {name}"
+            lines.append(line)
+        return "\n".join(lines)
+
+    async def transfer(self, address: tuple, blobs: list):
+        """Copies the blobs a worker is missing to it, from a worker holding them or from the coordinator."""
+        response, _ = await request(address, {"op": "has", "blobs": blobs}, timeout=self.timeout, token=self.token)
+        for blob in blobs:
+            if blob in response["present"]:
+                self.locations.setdefault(blob, set()).add(address)
+                continue
+            peers = [peer for peer in self.locations.get(blob, ()) if self.workers[peer]["healthy"]]
+            if self.store.has(blob):
+                await request(address, {"op": "put", "blob": blob}, path=self.store.path(blob), timeout=self.timeout, token=self.token)
+            elif peers:
+                await request(address, {"op": "fetch", "blob": blob, "peer": list(peers[0])}, timeout=self.timeout, token=self.token)
+            else:
+                raise DistributedError(f"No worker holds blob {blob}")
+            self.locations.setdefault(blob, set()).add(address)
+
+    async def dispatch(self, script: str) -> list:
+        """
+        Runs one step, retrying on another worker when a node fails.
+
+        :param script: The step, reading its inputs through blob references.
+        :type script: str
+        :return: The rendered blobs, as {"name", "filename", "blob", "size"}.
+        :rtype: list
+        :raises DistributedError: If the step fails on every worker tried.
+        :raises RemoteError: If the script itself is invalid.
+        """
+        blobs = list(dict.fromkeys(BLOB_REFERENCE.findall(script)))
+        tried = set()
+        errors = []
+        for _ in range(self.retries + 1):
+            address = self.choose(blobs, tried)
+            if address is None:
+                break
+            tried.add(address)
+            state = self.workers[address]
+            state["active"] += 1
+            try:
+                await self.transfer(address, blobs)
+                response, _ = await request(address, {"op": "run", "script": script}, token=self.token)
+            except RemoteError as e:
+                if e.kind == "script":
+                    raise
+                errors.append(f"{address[0]}:{address[1]}: {e}")
+                continue
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                errors.append(f"{address[0]}:{address[1]}: {e!r}")
+                self.mark_down(address)
+                continue
+            finally:
+                state["active"] -= 1
+            for result in response["results"]:
+                if not is_blob_id(result["blob"]):
+                    raise DistributedError(f"Worker {address[0]}:{address[1]} answered an invalid blob id")
+                self.locations.setdefault(result["blob"], set()).add(address)
+                self.sizes[result["blob"]] = result["size"]
+            return response["results"]
+        raise DistributedError("Step failed on every worker tried: " + "; ".join(errors or ["no healthy workers"]))
+
+    async def fetch(self, blob: str, destination: str):
+        """Copies a blob from a worker holding it to a local file."""
+        for address in list(self.locations.get(blob, ())):
+            try:
+                await request(address, {"op": "get", "blob": blob}, response_path=destination, timeout=self.timeout, token=self.token)
+                return
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, RemoteError):
+                self.mark_down(address)
+        raise DistributedError(f"No worker holds blob {blob}")
+
+    async def run(self, code: str, destination: str = None) -> dict:
+        """
+        Runs a script on the workers.
+
+        Independent branches of the script run at the same time, then the rest
+        of the script runs where most of their outputs are.
+
+        :param code: The script.
+        :type code: str
+        :param destination: The directory for rendered files, the working directory when not given.
+        :type destination: str
+        :return: Results shaped like those of parse, with the number of branches.
+        :rtype: dict
+        """
+        start_time = time.time()
+        plan = compile_plan(await self.upload(code))
+        branches = await asyncio.gather(*(self.dispatch(branch["script"]) for branch in plan["branches"]))
+        final = plan["final"]
+        for number, results in enumerate(branches):
+            final = final.replace(f"branch:{number} ", f"blob:{results[0]['blob']} ")
+        results = await self.dispatch(final)
+        attachments = []
+        for result in results:
+            extension = os.path.splitext(result["filename"])[1]
+            # Names come from the worker, keep them inside the destination
+            file = os.path.join(destination or os.getcwd(), os.path.basename(f"{result['name']}{extension}"))
+            await self.fetch(result["blob"], file)
+            attachments.append({"file": file, "name": result["name"]})
+        return {"time": time.time() - start_time, "attachments": attachments, "branches": len(plan["branches"])}
+
+async def spawn_local_workers(count: int, slots: int = 1, token: str = None) -> list:
+    """
+    Starts worker processes on this machine, each with its own blob store, to
+    stand in for nodes. They listen on loopback only.
+
+    :param count: How many workers to start.
+    :type count: int
+    :param slots: How many scripts each worker runs at once.
+    :type slots: int
+    :param token: A shared secret for the workers to require.
+    :type token: str
+    :return: The processes and their addresses, as (process, (host, port)).
+    :rtype: list
+    """
+    workers = []
+    for _ in range(count):
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "MediaScript.distributed.worker", "--slots", str(slots),
+            stdout=asyncio.subprocess.PIPE,
+            env=dict(os.environ, MEDIASCRIPT_TOKEN=token) if token else None,
+            cwd=os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        )
+        line = (await process.stdout.readline()).decode().split()
+        if len(line) != 3 or line[0] != "listening":
+            process.kill()
+            await process.wait()
+            raise DistributedError("Worker failed to start")
+        workers.append((process, (line[1], int(line[2]))))
+    return workers
+
+async def stop_local_workers(workers: list):
+    """Stops workers started by spawn_local_workers."""
+    for process, _ in workers:
+        if process.returncode is None:
+            process.terminate()
+            await process.wait()
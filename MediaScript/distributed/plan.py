@@ -0,0 +1,112 @@
+import os
+from urllib.parse import urlparse
+from ..parser.parse import get_commands
+from ..parser.planner import media_arguments
+
+# Commands that start a new media, and the position of its name
+_DEFINES = {"load": 2, "loadfile": 2, "tti": 1, "clone": 2}
+
+def _command(commands: list, name: str):
+    """Returns the definition of a command or one of its aliases."""
+    return next((c for c in commands if c["name"] == name or name in c.get("aliases", [])), None)
+
+def _defined_name(cmd_name: str, parameters: list):
+    """Returns the media a line creates, if any."""
+    position = _DEFINES.get(cmd_name)
+    if position is None:
+        return None
+    if position < len(parameters):
+        return parameters[position]
+    if cmd_name in ("load", "loadfile") and len(parameters) > 1:
+        return os.path.basename(urlparse(parameters[1]).path)
+    return None
+
+def compile_plan(code: str, commands: list = None) -> dict:
+    """
+    Splits a script into branches that can run on separate workers.
+
+    A branch is a media that is loaded and edited on its own until it meets
+    another media (overlay, join, audioputmix). Each branch becomes a script
+    that renders that media, and the rest of the script loads the rendered
+    blobs in place of the branch lines, through ``branch:<index>`` references.
+    ``set`` lines are copied into every branch since they only touch variables.
+
+    Scripts using ``get`` read media while they run, so they are never split.
+    Neither are scripts with fewer than two branches, since nothing would run
+    in parallel.
+
+    :param code: The script.
+    :type code: str
+    :param commands: The command definitions, loaded from commands.json when not given.
+    :type commands: list
+    :return: "branches", a list of {"name", "script"}, and "final", the remaining script.
+    :rtype: dict
+    """
+    commands = commands or get_commands()
+    lines = [line for line in code.splitlines() if line.strip() and not line.startswith("#")]
+    whole = {"branches": [], "final": "\n".join(lines)}
+    parsed = []
+    for line in lines:
+        cmd_def = _command(commands, line.split()[0])
+        if not cmd_def or cmd_def["name"] == "get":
+            return whole
+        parsed.append((cmd_def, line.split(maxsplit=len(cmd_def["args"]))))
+        if cmd_def["name"] == "render":
+            # Nothing after the render runs
+            break
+
+    # Group medias that depend on each other, keeping the groups as they were when they merged
+    owner = {}
+    groups = []
+    for index, (cmd_def, parameters) in enumerate(parsed):
+        if cmd_def["name"] == "set":
+            continue
+        reads = [parameters[p] for p in media_arguments(cmd_def) if p < len(parameters)]
+        defined = _defined_name(cmd_def["name"], parameters)
+        roots = {owner[name] for name in reads + [defined] if name in owner}
+        if len(roots) <= 1 and defined not in owner:
+            if roots:
+                root = roots.pop()
+            else:
+                root = len(groups)
+                groups.append({"names": set(), "lines": [], "merged_at": None, "source": True})
+            groups[root]["lines"].append(index)
+            if defined:
+                groups[root]["names"].add(defined)
+                owner[defined] = root
+            continue
+        # The line reads medias of several groups, or redefines one
+        merged = {"names": set(), "lines": [index], "merged_at": None, "source": False}
+        groups.append(merged)
+        for root in roots:
+            groups[root]["merged_at"] = index
+            merged["names"] |= groups[root]["names"]
+        if defined:
+            merged["names"].add(defined)
+        for name in merged["names"]:
+            owner[name] = len(groups) - 1
+
+    branches = [
+        group for group in groups
+        if group["source"] and group["merged_at"] is not None and len(group["names"]) == 1 and len(group["lines"]) > 1
+    ]
+    if len(branches) < 2:
+        return whole
+
+    set_lines = [index for index, (cmd_def, _) in enumerate(parsed) if cmd_def["name"] == "set"]
+    moved = {}
+    plan = {"branches": [], "final": ""}
+    for number, group in enumerate(branches):
+        name = next(iter(group["names"]))
+        indices = sorted(group["lines"] + [i for i in set_lines if i < group["merged_at"]])
+        script = [lines[i] for i in indices] + [f"render {name} {name}"]
+        plan["branches"].append({"name": name, "script": "\n".join(script)})
+        moved[group["lines"][0]] = f"loadfile branch:{number} {name}"
+        moved.update({i: None for i in group["lines"][1:]})
+    final = []
+    for index in range(len(parsed)):
+        line = moved.get(index, lines[index])
+        if line:
+            final.append(line)
+    plan["final"] = "\n".join(final)
+    return plan
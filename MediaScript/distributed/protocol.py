@@ -0,0 +1,117 @@
+import asyncio
+import json
+import os
+import struct
+
+CHUNK_SIZE = 1024 * 1024
+_LENGTH = struct.Struct(">I")
+
+class RemoteError(Exception):
+    """
+    Exception raised when the other side answers a request with an error.
+
+    ``kind`` is "script" when the script itself is invalid and running it
+    elsewhere would fail the same way, and "node" otherwise.
+    """
+    def __init__(self, message: str, kind: str = "node"):
+        super().__init__(message)
+        self.kind = kind
+
+async def send_message(writer: asyncio.StreamWriter, header: dict, payload: bytes = b"", path: str = None):
+    """
+    Sends one message: a length-prefixed JSON header followed by a raw payload.
+
+    :param writer: The connection.
+    :type writer: asyncio.StreamWriter
+    :param header: The header, its "size" is set to the payload size.
+    :type header: dict
+    :param payload: The payload, when it is in memory.
+    :type payload: bytes
+    :param path: A file to stream as the payload instead.
+    :type path: str
+    """
+    size = os.path.getsize(path) if path else len(payload)
+    data = json.dumps(dict(header, size=size)).encode()
+    writer.write(_LENGTH.pack(len(data)) + data)
+    if path:
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                writer.write(chunk)
+                await writer.drain()
+    else:
+        writer.write(payload)
+    await writer.drain()
+
+async def recv_header(reader: asyncio.StreamReader) -> dict:
+    """Reads the header of a message. Its "size" is the size of the payload that follows."""
+    length = _LENGTH.unpack(await reader.readexactly(_LENGTH.size))[0]
+    return json.loads(await reader.readexactly(length))
+
+async def recv_payload(reader: asyncio.StreamReader, size: int, path: str = None) -> bytes:
+    """
+    Reads the payload of a message.
+
+    :param reader: The connection.
+    :type reader: asyncio.StreamReader
+    :param size: The size from the header.
+    :type size: int
+    :param path: A file to stream the payload into instead of returning it.
+    :type path: str
+    :return: The payload, or empty bytes when written to path.
+    :rtype: bytes
+    """
+    if path is None:
+        return await reader.readexactly(size)
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining:
+            chunk = await reader.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                raise asyncio.IncompleteReadError(b"", remaining)
+            f.write(chunk)
+            remaining -= len(chunk)
+    return b""
+
+async def request(address: tuple, header: dict, payload: bytes = b"", path: str = None, response_path: str = None, timeout: float = None, token: str = None):
+    """
+    Sends a request on a new connection and waits for the response.
+
+    :param address: The (host, port) to connect to.
+    :type address: tuple
+    :param header: The request header, with its "op".
+    :type header: dict
+    :param payload: The request payload.
+    :type payload: bytes
+    :param path: A file to stream as the request payload.
+    :type path: str
+    :param response_path: A file to stream the response payload into.
+    :type response_path: str
+    :param timeout: Seconds to wait for the connection and for the response, None to wait forever.
+    :type timeout: float
+    :param token: The shared secret of the cluster, sent with the request.
+    :type token: str
+    :return: The response header and payload.
+    :rtype: tuple
+    :raises RemoteError: If the response is an error.
+    """
+    if token:
+        header = dict(header, token=token)
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(*address), timeout)
+    try:
+        await send_message(writer, header, payload, path)
+        response = await asyncio.wait_for(recv_header(reader), timeout)
+        size = response.pop("size", 0)
+        if "error" in response:
+            await reader.readexactly(size)
+            raise RemoteError(response["error"], response.get("kind", "node"))
+        data = await asyncio.wait_for(recv_payload(reader, size, response_path), timeout)
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+    return response, data
@@ -0,0 +1,210 @@
+import argparse
+import asyncio
+import hmac
+import ipaddress
+import os
+import shutil
+import signal
+import tempfile
+from collections import Counter
+from ..parser.parse import IscriptError, parse
+from .blobstore import BLOB_REFERENCE, BlobStore, is_blob_id
+from .protocol import RemoteError, recv_header, recv_payload, request, send_message
+
+class Worker:
+    """
+    A node that runs scripts for a coordinator.
+
+    Inputs and outputs are blobs in the worker's store. A script reads its
+    inputs through ``blob:<id>`` references and its rendered media are added
+    to the store, so the next step that reads them can run here without a
+    transfer. Past max_bytes, the least recently used blobs not read by a
+    running script are evicted.
+
+    With a token, requests without the same token are refused. Workers
+    listening beyond loopback need one, since a request can read any blob and
+    run any script.
+    """
+    def __init__(self, store: BlobStore, slots: int = 1, token: str = None, max_bytes: int = None):
+        """
+        :param store: The blob store of the node.
+        :type store: BlobStore
+        :param slots: How many scripts run at once.
+        :type slots: int
+        :param token: The shared secret of the cluster.
+        :type token: str
+        :param max_bytes: The size the blob store may use, None for no limit.
+        :type max_bytes: int
+        """
+        self.store = store
+        self.slots = slots
+        self.token = token
+        self.max_bytes = max_bytes
+        self.active = 0
+        self._slots = asyncio.Semaphore(slots)
+        # Blobs read by running scripts, never evicted
+        self._pinned = Counter()
+
+    def _check_blob(self, blob):
+        """Refuses anything but a blob id before it reaches the store."""
+        if not is_blob_id(blob):
+            raise RemoteError(f"Invalid blob id {blob!r}", "script")
+        return blob
+
+    def _evict(self, keep=()):
+        if self.max_bytes is not None:
+            self.store.evict(self.max_bytes, set(self._pinned) | set(keep))
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Answers one request."""
+        try:
+            header = await recv_header(reader)
+            op = header.get("op")
+            path = None
+            if self.token and not hmac.compare_digest(str(header.get("token", "")), self.token):
+                # Refuse before reading the payload
+                await send_message(writer, {"error": "Invalid token", "kind": "script"})
+                return
+            try:
+                if op == "put":
+                    blob = self._check_blob(header.get("blob"))
+                    incoming = self.store.incoming()
+                    try:
+                        await recv_payload(reader, header["size"], incoming)
+                        self.store.commit(incoming, blob)
+                    finally:
+                        if os.path.exists(incoming):
+                            os.remove(incoming)
+                    self._evict(keep=[blob])
+                    response = {"ok": True}
+                else:
+                    await recv_payload(reader, header["size"])
+                    if op == "health":
+                        response = {"ok": True, "active": self.active, "slots": self.slots}
+                    elif op == "has":
+                        blobs = [self._check_blob(blob) for blob in header.get("blobs", [])]
+                        response = {"present": [blob for blob in blobs if self.store.has(blob)]}
+                    elif op == "get":
+                        blob = self._check_blob(header.get("blob"))
+                        if not self.store.has(blob):
+                            raise KeyError(blob)
+                        self.store.touch(blob)
+                        response, path = {"ok": True}, self.store.path(blob)
+                    elif op == "fetch":
+                        peer = header.get("peer")
+                        if not (isinstance(peer, list) and len(peer) == 2 and isinstance(peer[0], str) and isinstance(peer[1], int)):
+                            raise RemoteError(f"Invalid peer {peer!r}", "script")
+                        response = await self.fetch(self._check_blob(header.get("blob")), tuple(peer))
+                    elif op == "run":
+                        response = await self.run(header["script"])
+                    else:
+                        raise ValueError(f"Unknown op {op}")
+            except RemoteError as e:
+                response = {"error": str(e), "kind": e.kind}
+            except IscriptError as e:
+                response = {"error": str(e), "kind": "script"}
+            except Exception as e:
+                response = {"error": f"{type(e).__name__}: {e}", "kind": "node"}
+            await send_message(writer, response, path=path)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def fetch(self, blob: str, peer: tuple) -> dict:
+        """Copies a blob from another worker into the store."""
+        if not self.store.has(blob):
+            incoming = self.store.incoming()
+            try:
+                await request(peer, {"op": "get", "blob": blob}, response_path=incoming, token=self.token)
+                self.store.commit(incoming, blob)
+            finally:
+                if os.path.exists(incoming):
+                    os.remove(incoming)
+            self._evict(keep=[blob])
+        return {"ok": True}
+
+    async def run(self, script: str) -> dict:
+        """
+        Runs a script and stores what it renders.
+
+        :param script: The script, reading its inputs through blob references.
+        :type script: str
+        :return: The rendered blobs, as {"name", "filename", "blob", "size"}.
+        :rtype: dict
+        """
+        inputs = BLOB_REFERENCE.findall(script)
+        self._pinned.update(inputs)
+        try:
+            script = self.store.resolve(script)
+        except KeyError as e:
+            self._pinned -= Counter(inputs)
+            raise RemoteError(f"Missing blob {e.args[0]}")
+        async with self._slots:
+            self.active += 1
+            output_dir = tempfile.mkdtemp(prefix="mediascript_worker_")
+            rendered = []
+            try:
+                results = await parse(script, destination=output_dir)
+                if not results["attachments"]:
+                    raise RemoteError("The script rendered nothing")
+                for attachment in results["attachments"]:
+                    if not os.path.exists(attachment["file"]):
+                        raise RemoteError(f"{attachment['name']} was not rendered")
+                    blob = self.store.put(attachment["file"], move=True)
+                    rendered.append({
+                        "name": attachment["name"],
+                        "filename": os.path.basename(attachment["file"]),
+                        "blob": blob,
+                        "size": self.store.size(blob),
+                    })
+                return {"results": rendered, "time": results["time"]}
+            finally:
+                self.active -= 1
+                shutil.rmtree(output_dir, ignore_errors=True)
+                self._pinned -= Counter(inputs)
+                self._evict(keep=[result["blob"] for result in rendered])
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 0):
+        """
+        Listens for requests until cancelled.
+
+        The address is printed as ``listening <host> <port>`` once the worker is
+        ready, so a parent process can use port 0 and read the chosen port.
+        """
+        server = await asyncio.start_server(self.handle, host, port)
+        host, port = server.sockets[0].getsockname()[:2]
+        print(f"listening {host} {port}", flush=True)
+        async with server:
+            await server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a MediaScript worker node.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0, help="0 picks a free port")
+    parser.add_argument("--store", default=None, help="blob store directory, temporary when not given")
+    parser.add_argument("--slots", type=int, default=1, help="scripts run at once")
+    parser.add_argument("--max-bytes", type=int, default=None, help="evict least recently used blobs past this size")
+    args = parser.parse_args()
+    # Read from the environment so the secret does not show up in the process list
+    token = os.environ.get("MEDIASCRIPT_TOKEN")
+    try:
+        loopback = args.host == "localhost" or ipaddress.ip_address(args.host).is_loopback
+    except ValueError:
+        loopback = False
+    if not loopback and not token:
+        parser.error("set MEDIASCRIPT_TOKEN to listen beyond loopback")
+    store = BlobStore(args.store)
+    worker = Worker(store, args.slots, token, args.max_bytes)
+    # Stop on SIGTERM the same way as on Ctrl+C, so the store is cleaned up
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        asyncio.run(worker.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # A temporary store goes away with the worker
+        store.close()
+
+if __name__ == "__main__":
+    main()
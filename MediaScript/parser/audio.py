@@ -0,0 +1,136 @@
+import array
+import os
+import sys
+import wave
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Commands that only scale pitch, tempo or gain. Consecutive ones on a media are
+# composed and run as a single stage when the media is next read.
+AUDIO_COMMANDS = {"audiopitch", "speed", "volume"}
+
+# Formant setting passed to rubberband by every pitch and tempo change
+RUBBERBAND_FORMANT = 712923000
+
+def compose_audio(chain: dict, cmd_name: str, value: float) -> dict:
+    """
+    Adds one audio command to a pending chain.
+
+    Pitch ratios multiply, tempo ratios multiply and gains multiply, so any
+    sequence of these commands collapses into one ratio of each.
+
+    :param chain: The pending chain of the media, or None.
+    :type chain: dict
+    :param cmd_name: One of ``AUDIO_COMMANDS``.
+    :type cmd_name: str
+    :param value: The evaluated argument of the command.
+    :type value: float
+    :return: A new chain, the given one is not modified.
+    :rtype: dict
+    """
+    chain = dict(chain) if chain else {"pitch": 1.0, "tempo": 1.0, "gain": 1.0}
+    if cmd_name == "audiopitch":
+        chain["pitch"] *= value
+    elif cmd_name == "speed":
+        chain["tempo"] *= value
+    elif cmd_name == "volume":
+        chain["gain"] *= value
+    return chain
+
+def is_identity(chain: dict) -> bool:
+    """Whether a chain leaves the media unchanged."""
+    return chain["pitch"] == 1 and chain["tempo"] == 1 and chain["gain"] == 1
+
+def audio_filters(chain: dict) -> list:
+    """Returns the audio filters of a chain, one rubberband and one volume stage at most."""
+    filters = []
+    stretch = []
+    if chain["pitch"] != 1:
+        stretch.append(f"pitch={chain['pitch']}")
+    if chain["tempo"] != 1:
+        stretch.append(f"tempo={chain['tempo']}")
+    if stretch:
+        filters.append(f"rubberband={':'.join(stretch)}:formant={RUBBERBAND_FORMANT}")
+    if chain["gain"] != 1:
+        filters.append(f"volume={chain['gain']}")
+    return filters
+
+def video_filters(chain: dict, fps: int = 30) -> list:
+    """Returns the video filters keeping the picture in time with a tempo change, none without one."""
+    if chain["tempo"] == 1:
+        return []
+    return [f"setpts=1/{chain['tempo']}*PTS", f"fps={fps}"]
+
+def audio_args(chain: dict) -> list:
+    """
+    Builds the FFmpeg arguments running a chain as one rubberband and volume stage.
+
+    :param chain: The composed chain.
+    :type chain: dict
+    :return: The ffmpeg arguments.
+    :rtype: list
+    """
+    args = []
+    if video_filters(chain):
+        args += ["-vf", ",".join(video_filters(chain))]
+    if audio_filters(chain):
+        args += ["-af", ",".join(audio_filters(chain))]
+    return args
+
+def can_apply_in_process(input_file: str, chain: dict) -> bool:
+    """
+    Whether a chain can skip FFmpeg.
+
+    Gain-only chains on WAV files have no video and need no resampling, so the
+    samples are scaled directly.
+    """
+    if os.path.splitext(input_file)[1].lower() != ".wav" or chain["pitch"] != 1 or chain["tempo"] != 1:
+        return False
+    try:
+        with wave.open(input_file, "rb") as source:
+            return source.getsampwidth() in (1, 2, 4) and source.getcomptype() == "NONE"
+    except (wave.Error, EOFError, OSError):
+        return False
+
+def apply_gain(input_file: str, output_file: str, gain: float):
+    """
+    Scales the PCM samples of a WAV file, clipping to the sample range.
+
+    :param input_file: The input WAV file.
+    :type input_file: str
+    :param output_file: The output WAV file.
+    :type output_file: str
+    :param gain: The linear gain.
+    :type gain: float
+    """
+    with wave.open(input_file, "rb") as source:
+        params = source.getparams()
+        frames = source.readframes(params.nframes)
+    width = params.sampwidth
+    if numpy is not None:
+        dtype = {1: "u1", 2: "<i2", 4: "<i4"}[width]
+        samples = numpy.frombuffer(frames, dtype=dtype).astype(numpy.float64)
+        if width == 1:
+            samples = (samples - 128) * gain + 128
+        else:
+            samples *= gain
+        info = numpy.iinfo(dtype)
+        scaled = numpy.clip(numpy.round(samples), info.min, info.max).astype(dtype)
+    elif width == 1:
+        # 8-bit WAV is unsigned and centered on 128
+        samples = array.array("B", frames)
+        scaled = array.array("B", (min(255, max(0, round((s - 128) * gain) + 128)) for s in samples))
+    else:
+        typecode = {2: "h", 4: "i"}[width]
+        samples = array.array(typecode, frames)
+        if sys.byteorder == "big":
+            samples.byteswap()
+        limit = 2 ** (width * 8 - 1)
+        scaled = array.array(typecode, (min(limit - 1, max(-limit, round(s * gain))) for s in samples))
+        if sys.byteorder == "big":
+            scaled.byteswap()
+    with wave.open(output_file, "wb") as target:
+        target.setparams(params)
+        target.writeframes(scaled.tobytes())
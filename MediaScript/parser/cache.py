@@ -0,0 +1,84 @@
+import getpass
+import os
+import shutil
+import tempfile
+import uuid
+
+def _default_root() -> str:
+    """Returns the cache directory of the current user."""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    if not os.path.isabs(base):
+        # No home directory, keep the caches apart per user in the temp directory
+        base = os.path.join(tempfile.gettempdir(), f"mediascript-{getpass.getuser()}")
+    return os.path.join(base, "mediascript")
+
+# Where the caches that outlive a script live, MEDIASCRIPT_CACHE_DIR moves them
+CACHE_ROOT = os.environ.get("MEDIASCRIPT_CACHE_DIR") or _default_root()
+# Bytes each cache may hold, the least recently used files are removed past it
+CACHE_MAX_BYTES = int(os.environ.get("MEDIASCRIPT_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+def cache_dir(name: str) -> str:
+    """Returns the directory of a cache, creating it readable by the current user only."""
+    path = os.path.join(CACHE_ROOT, name)
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    return path
+
+def lookup(path: str) -> bool:
+    """Whether a cached file exists, marking it as recently used."""
+    try:
+        os.utime(path)
+        return True
+    except OSError:
+        return False
+
+def temporary(directory: str) -> str:
+    """Returns a unique path in a cache to write a file into before it is stored."""
+    return os.path.join(directory, f"tmp_{uuid.uuid4().hex}")
+
+def store(source: str, path: str):
+    """
+    Adds a file to a cache, then trims the cache to CACHE_MAX_BYTES.
+
+    :param source: The file, moved into the cache. A path from ``temporary`` is renamed in place.
+    :type source: str
+    :param path: Its path in the cache.
+    :type path: str
+    """
+    directory = os.path.dirname(path)
+    if os.path.dirname(source) != directory:
+        # Move next to the entry first, so readers never see a partial file
+        incoming = temporary(directory)
+        shutil.move(source, incoming)
+        source = incoming
+    os.replace(source, path)
+    trim(directory)
+
+def trim(directory: str, max_bytes: int = None):
+    """
+    Removes the least recently used files of a cache until it fits.
+
+    :param directory: The cache directory.
+    :type directory: str
+    :param max_bytes: The size the cache may use, CACHE_MAX_BYTES when not given.
+    :type max_bytes: int
+    """
+    max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    entries = []
+    for entry in os.listdir(directory):
+        if entry.startswith("tmp_"):
+            # Still being written
+            continue
+        try:
+            stat = os.stat(os.path.join(directory, entry))
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry))
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(directory, entry))
+            total -= size
+        except OSError:
+            pass
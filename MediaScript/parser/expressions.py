@@ -0,0 +1,80 @@
+import ast
+import math
+import types
+from functools import lru_cache
+
+class ExpressionError(Exception):
+    """Exception raised when a valid expression fails to evaluate."""
+    pass
+
+# Every public name of the math module, built once
+MATH_NAMESPACE = types.MappingProxyType({k: v for k, v in vars(math).items() if not k.startswith("__")})
+_GLOBALS = {"__builtins__": {}, **MATH_NAMESPACE}
+
+_ALLOWED_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp,
+    ast.Call, ast.Name, ast.Load, ast.Constant, ast.Tuple,
+    ast.operator, ast.unaryop, ast.boolop, ast.cmpop,
+)
+
+def _validate(tree: ast.AST) -> bool:
+    """Whether a parsed expression only uses arithmetic, comparisons and math functions."""
+    for node in ast.walk(tree):
+        if not isinstance(node, _ALLOWED_NODES):
+            return False
+        if isinstance(node, ast.Call) and (not isinstance(node.func, ast.Name) or node.keywords):
+            return False
+    return True
+
+@lru_cache(maxsize=1024)
+def compile_expression(expression: str):
+    """
+    Parses, validates and compiles an expression once.
+
+    :param expression: The expression text.
+    :type expression: str
+    :return: The code object and the names it reads, or None if the text is not an
+      expression, like a color or a file path.
+    :rtype: tuple
+    """
+    try:
+        tree = ast.parse(expression.strip(), mode="eval")
+    except (SyntaxError, ValueError):
+        return None
+    if not _validate(tree):
+        return None
+    names = tuple(sorted({node.id for node in ast.walk(tree) if isinstance(node, ast.Name)}))
+    return compile(tree, "<expression>", "eval"), names
+
+def evaluate(expression: str, variables: dict):
+    """
+    Evaluates an expression against the math namespace and the script variables.
+
+    Text that is not an expression is returned as is, and so is a single bare
+    name that is neither a variable nor part of math, like a color or a file
+    name. A compound expression reading such a name is an error, so a typo
+    fails here rather than as a bad number later.
+
+    :param expression: The expression text.
+    :type expression: str
+    :param variables: The script variables.
+    :type variables: dict
+    :return: The value of the expression.
+    :raises ExpressionError: If the expression reads an undefined name or fails to evaluate.
+    """
+    compiled = compile_expression(expression)
+    if compiled is None:
+        return expression
+    code, names = compiled
+    slots = {}
+    for name in names:
+        if name in variables:
+            slots[name] = variables[name]
+        elif name not in MATH_NAMESPACE:
+            if names == (expression.strip(),):
+                return expression
+            raise ExpressionError(f"Could not evaluate '{expression}': '{name}' is not defined")
+    try:
+        return eval(code, _GLOBALS, slots)
+    except Exception as e:
+        raise ExpressionError(f"Could not evaluate '{expression}': {e}")
@@ -0,0 +1,279 @@
+import asyncio
+import json
+import math
+import os
+from .planner import media_arguments
+
+# Ceilings applied when parse is given limits. Pass None for a limit to lift it.
+DEFAULT_LIMITS = {
+    # Inputs over these are scaled, resampled or cut in normalize mode
+    "max_width": 1920,
+    "max_height": 1080,
+    "max_fps": 30,
+    "max_duration": 300.0,
+    # Pixels times frames of a single input
+    "max_cost": None,
+    # Bytes of a single input, after normalizing
+    "max_file_size": None,
+    # Estimated pixel-frames of work for the whole script, checked before it runs
+    "max_script_cost": None,
+    # "normalize" fits inputs to the ceilings in one FFmpeg pass, "reject" refuses them
+    "mode": "normalize",
+}
+
+# Work per pixel-frame of each command, relative to a plain filter pass
+# The geq commands evaluate an expression per pixel
+COMMAND_WEIGHTS = {
+    "swirl": 10,
+    "explode": 10,
+    "reverse": 3,
+    "hueshifthsv": 2,
+    "blur": 2,
+    "set": 0,
+    "get": 0,
+    "load": 0,
+    "loadfile": 0,
+    "tti": 0,
+    "clone": 0,
+    "render": 0,
+    # Deferred and fused into one audio stage
+    "volume": 0.5,
+    "audiopitch": 0.5,
+    "speed": 0.5,
+}
+
+class BudgetExceededError(Exception):
+    """Exception raised when an input or a script is over the limits."""
+    pass
+
+def _fps(rate: str) -> float:
+    """Parses an ffprobe frame rate like 30000/1001."""
+    try:
+        numerator, _, denominator = rate.partition("/")
+        return float(numerator) / float(denominator or 1)
+    except (ValueError, ZeroDivisionError, AttributeError):
+        return 0.0
+
+async def probe(path: str) -> dict:
+    """
+    Probes a media file once for everything the governor checks.
+
+    :param path: The media file.
+    :type path: str
+    :return: width, height, fps, duration, frames and size. Dimensions are None
+      without a video stream, and a still image has a single frame.
+    :rtype: dict
+    """
+    process = await asyncio.create_subprocess_exec(
+        'ffprobe', '-v', 'error',
+        '-select_streams', 'v:0',
+        '-show_entries', 'stream=width,height,avg_frame_rate:format=duration',
+        '-of', 'json', path,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stdout, _ = await process.communicate()
+    try:
+        data = json.loads(stdout or b"{}")
+    except ValueError:
+        data = {}
+    stream = (data.get("streams") or [{}])[0]
+    try:
+        duration = float(data.get("format", {}).get("duration", 0))
+    except ValueError:
+        duration = 0.0
+    fps = _fps(stream.get("avg_frame_rate"))
+    return {
+        "width": stream.get("width"),
+        "height": stream.get("height"),
+        "fps": fps,
+        "duration": duration,
+        "frames": max(1, round(fps * duration)) if fps and duration else 1,
+        "size": os.path.getsize(path),
+    }
+
+def cost(info: dict) -> float:
+    """Returns the pixel-frames of a probed media."""
+    return (info["width"] or 0) * (info["height"] or 0) * info["frames"]
+
+class Governor:
+    """
+    Keeps inputs within resource limits.
+
+    Every loaded media is probed once and checked against the limits. In
+    normalize mode an input over a ceiling is scaled down (keeping even
+    dimensions), resampled and cut in a single FFmpeg pass. In reject mode, and
+    for limits normalizing cannot meet, the script stops with
+    BudgetExceededError.
+    """
+    def __init__(self, limits: dict = None):
+        """
+        :param limits: Limits overriding DEFAULT_LIMITS.
+        :type limits: dict
+        """
+        unknown = set(limits or {}) - set(DEFAULT_LIMITS)
+        if unknown:
+            raise ValueError(f"Unknown limits: {', '.join(sorted(unknown))}")
+        self.limits = {**DEFAULT_LIMITS, **(limits or {})}
+        if self.limits["mode"] not in ("normalize", "reject"):
+            raise ValueError(f"Unknown governor mode '{self.limits['mode']}', expected normalize or reject.")
+        # Probes of loadfile sources, reused when the copy is admitted
+        self.probes = {}
+
+    async def probe_source(self, path: str) -> dict:
+        """Probes a loadfile source, once per path, size and mtime."""
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        if key not in self.probes:
+            self.probes[key] = await probe(path)
+        return self.probes[key]
+
+    def violations(self, info: dict) -> list:
+        """Returns the limits a probed media is over."""
+        limits = self.limits
+        over = []
+        if info["width"] and limits["max_width"] and info["width"] > limits["max_width"]:
+            over.append(f"width {info['width']} > {limits['max_width']}")
+        if info["height"] and limits["max_height"] and info["height"] > limits["max_height"]:
+            over.append(f"height {info['height']} > {limits['max_height']}")
+        if info["frames"] > 1 and limits["max_fps"] and info["fps"] > limits["max_fps"]:
+            over.append(f"fps {info['fps']:g} > {limits['max_fps']}")
+        if limits["max_duration"] and info["duration"] > limits["max_duration"]:
+            over.append(f"duration {info['duration']:g}s > {limits['max_duration']:g}s")
+        if limits["max_cost"] and cost(info) > limits["max_cost"]:
+            over.append(f"cost {cost(info):.0f} pixel-frames > {limits['max_cost']}")
+        if limits["max_file_size"] and info["size"] > limits["max_file_size"]:
+            over.append(f"size {info['size']} bytes > {limits['max_file_size']}")
+        return over
+
+    def fit(self, info: dict) -> dict:
+        """Returns what a media becomes once normalized to the ceilings."""
+        limits = self.limits
+        fitted = dict(info)
+        if info["width"] and info["height"]:
+            scale = min(1.0, (limits["max_width"] or info["width"]) / info["width"], (limits["max_height"] or info["height"]) / info["height"])
+            if scale < 1:
+                # Encoders need even dimensions
+                fitted["width"] = max(2, int(info["width"] * scale) // 2 * 2)
+                fitted["height"] = max(2, int(info["height"] * scale) // 2 * 2)
+        # Only a still has no duration to cut, audio without a video stream probes as a single frame too
+        still = info["width"] and info["frames"] == 1
+        if not still and limits["max_duration"] and info["duration"] > limits["max_duration"]:
+            fitted["duration"] = limits["max_duration"]
+        if info["frames"] > 1:
+            if limits["max_fps"] and info["fps"] > limits["max_fps"]:
+                fitted["fps"] = limits["max_fps"]
+            if limits["max_cost"] and fitted["width"] and fitted["height"]:
+                # Cut the duration to a whole number of frames that fits the cost once the picture is as small as allowed
+                frames = math.floor(limits["max_cost"] / (fitted["width"] * fitted["height"]))
+                fitted["duration"] = min(fitted["duration"], frames / fitted["fps"])
+            fitted["frames"] = max(1, round(fitted["fps"] * fitted["duration"]))
+        return fitted
+
+    def normalize_args(self, info: dict, fitted: dict) -> list:
+        """Returns the FFmpeg arguments turning a media into its fitted version, None when nothing changes."""
+        filters = []
+        if (fitted["width"], fitted["height"]) != (info["width"], info["height"]):
+            filters.append(f"scale={fitted['width']}:{fitted['height']}")
+        if fitted["fps"] != info["fps"]:
+            filters.append(f"fps={fitted['fps']}")
+        args = ["-vf", ",".join(filters)] if filters else []
+        if fitted["duration"] < info["duration"]:
+            args += ["-t", f"{fitted['duration']:.3f}"]
+        return args or None
+
+    async def admit(self, path: str, source: str = None) -> tuple:
+        """
+        Checks a newly loaded media.
+
+        :param path: The media file in the workspace.
+        :type path: str
+        :param source: The file it was copied from, to reuse its probe.
+        :type source: str
+        :return: The probe of the media and the FFmpeg arguments normalizing it, None when it is within limits.
+        :rtype: tuple
+        :raises BudgetExceededError: If the media is over the limits and cannot be normalized.
+        """
+        info = await self.probe_source(source) if source else await probe(path)
+        over = self.violations(info)
+        if not over:
+            return info, None
+        if self.limits["mode"] == "reject":
+            raise BudgetExceededError(f"{os.path.basename(source or path)} is over the limits: {', '.join(over)}.")
+        fitted = self.fit(info)
+        # The size is only known once the pass has run, check_size covers it
+        remaining = self.violations(dict(fitted, size=0))
+        if remaining:
+            raise BudgetExceededError(f"{os.path.basename(source or path)} cannot be normalized within the limits: {', '.join(remaining)}.")
+        return fitted, self.normalize_args(info, fitted)
+
+    def check_size(self, path: str):
+        """Raises BudgetExceededError if an admitted media, normalized or not, is over the file size limit."""
+        limit = self.limits["max_file_size"]
+        if limit and os.path.getsize(path) > limit:
+            raise BudgetExceededError(f"{os.path.basename(path)} is {os.path.getsize(path)} bytes, over the limit of {limit}.")
+
+    async def estimate(self, compiled: tuple, resolve_path) -> float:
+        """
+        Predicts the work of a script in pixel-frames before any of it runs.
+
+        loadfile sources are probed, medias from load are assumed to be at the
+        ceilings, and every command costs its weight times the size of the media
+        it edits.
+
+        :param compiled: The compiled script, from compile_script.
+        :type compiled: tuple
+        :param resolve_path: Turns a loadfile path into an absolute path.
+        :type resolve_path: callable
+        :return: The estimated pixel-frames.
+        :rtype: float
+        """
+        limits = self.limits
+        ceilings = [limits["max_width"], limits["max_height"], limits["max_fps"], limits["max_duration"]]
+        ceiling = math.prod(ceilings) if all(ceilings) else math.inf
+        sizes = {}
+        total = 0.0
+        for _, cmd_name, cmd_def, parameters in compiled:
+            if not cmd_def:
+                break
+            if cmd_name == "load" and len(parameters) > 1:
+                sizes[parameters[2] if len(parameters) > 2 else os.path.basename(parameters[1])] = ceiling
+            elif cmd_name == "loadfile" and len(parameters) > 1:
+                path = resolve_path(parameters[1])
+                info = await self.probe_source(path) if os.path.exists(path) else None
+                if info and limits["mode"] == "normalize":
+                    info = self.fit(info)
+                sizes[parameters[2] if len(parameters) > 2 else os.path.basename(path)] = cost(info) if info else 0
+            elif cmd_name == "tti" and len(parameters) > 3:
+                try:
+                    bounds = float(parameters[3])
+                except ValueError:
+                    bounds = 600.0
+                sizes[parameters[1]] = bounds * bounds
+            elif cmd_name == "clone" and len(parameters) > 2:
+                sizes[parameters[2]] = sizes.get(parameters[1], 0)
+            elif cmd_name == "join" and len(parameters) > 2:
+                sizes[parameters[1]] = sizes.get(parameters[1], 0) + sizes.get(parameters[2], 0)
+            positions = media_arguments(cmd_def)
+            weight = COMMAND_WEIGHTS.get(cmd_name, 1)
+            if weight and positions and positions[0] < len(parameters):
+                total += weight * sizes.get(parameters[positions[0]], 0)
+            if cmd_name == "render":
+                break
+        return total
+
+    async def check_script(self, compiled: tuple, resolve_path) -> float:
+        """
+        Estimates a script and refuses it when over max_script_cost.
+
+        :return: The estimated pixel-frames.
+        :rtype: float
+        :raises BudgetExceededError: If the estimate is over budget.
+        """
+        estimate = await self.estimate(compiled, resolve_path)
+        budget = self.limits["max_script_cost"]
+        if budget and estimate > budget:
+            if math.isinf(estimate):
+                raise BudgetExceededError("The script loads URLs without size ceilings, its cost cannot be bounded.")
+            raise BudgetExceededError(f"The script would take about {estimate:.3g} pixel-frames of work, over the budget of {budget:.3g}.")
+        return estimate
@@ -0,0 +1,173 @@
+import asyncio
+import os
+import shutil
+import weakref
+from typing import AsyncIterator
+
+# Ways parse can hand back rendered media
+OUTPUT_MODES = ("files", "bytes", "memoryview", "stream")
+
+CHUNK_SIZE = 64 * 1024
+
+# Containers that can be written to a pipe as fragmented MP4
+STREAMABLE_EXTENSIONS = {".mp4", ".m4v", ".mov"}
+FRAGMENTED_MP4_ARGS = ["-movflags", "frag_keyframe+empty_moov+default_base_moof", "-f", "mp4"]
+
+def move_file(source: str, destination: str) -> str:
+    """
+    Moves a rendered file to its destination with a single rename when possible.
+
+    Falls back to a copy when the destination is on another filesystem.
+
+    :param source: The rendered file.
+    :type source: str
+    :param destination: The destination path.
+    :type destination: str
+    :return: The destination path.
+    :rtype: str
+    """
+    try:
+        os.replace(source, destination)
+    except OSError:
+        shutil.move(source, destination)
+    return destination
+
+def read_file(path: str, as_memoryview: bool = False):
+    """
+    Reads a rendered file into memory.
+
+    :param path: The rendered file.
+    :type path: str
+    :param as_memoryview: Whether to return a memoryview over a buffer filled in place.
+    :type as_memoryview: bool
+    :return: The contents.
+    :rtype: Union[bytes, memoryview]
+    """
+    with open(path, "rb") as f:
+        if not as_memoryview:
+            return f.read()
+        buffer = bytearray(os.fstat(f.fileno()).st_size)
+        view = memoryview(buffer)
+        read = 0
+        while read < len(buffer):
+            count = f.readinto(view[read:])
+            if not count:
+                break
+            read += count
+        return view[:read]
+
+class MediaStream:
+    """
+    The chunks of a streamed render, read with ``async for``.
+
+    The workspace the stream reads from is removed when the stream ends or
+    fails, when ``aclose`` is called, or at the latest when the stream is
+    garbage collected, so a stream that is never read does not leak it.
+    """
+    def __init__(self, chunks: AsyncIterator[bytes], cleanup=None):
+        """
+        :param chunks: The chunks, produced lazily.
+        :type chunks: AsyncIterator[bytes]
+        :param cleanup: Called once when the stream is done, to remove the workspace.
+        :type cleanup: callable
+        """
+        self._chunks = chunks
+        self._cleanup = weakref.finalize(self, cleanup) if cleanup else None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        try:
+            return await self._chunks.__anext__()
+        except BaseException:
+            # Ended, failed or cancelled, nothing reads the workspace anymore
+            self._done()
+            raise
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        """Stops the stream, ending its FFmpeg process if any, and removes the workspace."""
+        try:
+            await self._chunks.aclose()
+        finally:
+            self._done()
+
+    def _done(self):
+        if self._cleanup:
+            self._cleanup()
+
+def stream_file(path: str, cleanup=None, chunk_size: int = CHUNK_SIZE) -> MediaStream:
+    """
+    Streams a rendered file in chunks.
+
+    :param path: The rendered file.
+    :type path: str
+    :param cleanup: Called once the stream is done, to remove the workspace.
+    :type cleanup: callable
+    :param chunk_size: The size of each chunk.
+    :type chunk_size: int
+    :return: The stream.
+    :rtype: MediaStream
+    """
+    return MediaStream(_file_chunks(path, chunk_size), cleanup)
+
+async def _file_chunks(path: str, chunk_size: int) -> AsyncIterator[bytes]:
+    """Yields a file in chunks."""
+    with open(path, "rb") as f:
+        while True:
+            chunk = await asyncio.to_thread(f.read, chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+def stream_ffmpeg(input_file: str, ffmpeg_args: list, cleanup=None, chunk_size: int = CHUNK_SIZE) -> MediaStream:
+    """
+    Runs the final FFmpeg stage with its output on stdout as fragmented MP4, and
+    streams the output as it is encoded. FFmpeg starts on the first read.
+
+    :param input_file: The input media file.
+    :type input_file: str
+    :param ffmpeg_args: The arguments of the stage.
+    :type ffmpeg_args: list
+    :param cleanup: Called once the stream is done, to remove the workspace.
+    :type cleanup: callable
+    :param chunk_size: The largest chunk to yield.
+    :type chunk_size: int
+    :return: The stream.
+    :rtype: MediaStream
+    """
+    return MediaStream(_ffmpeg_chunks(input_file, ffmpeg_args, chunk_size), cleanup)
+
+async def _ffmpeg_chunks(input_file: str, ffmpeg_args: list, chunk_size: int) -> AsyncIterator[bytes]:
+    """Yields the stdout of an FFmpeg run as it is encoded."""
+    process = await asyncio.create_subprocess_exec(
+        'ffmpeg',
+        '-i', input_file,
+        *ffmpeg_args,
+        *FRAGMENTED_MP4_ARGS,
+        'pipe:1',
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    # Drain stderr alongside stdout so FFmpeg never blocks on a full pipe
+    stderr = asyncio.create_task(process.stderr.read())
+    try:
+        while True:
+            chunk = await process.stdout.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        await process.wait()
+        if process.returncode != 0:
+            raise SystemError(f"FFmpeg process failed with error: {(await stderr).decode()}")
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        stderr.cancel()
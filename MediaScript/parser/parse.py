@@ -5,16 +5,96 @@ import os
 from urllib.parse import urlparse
 import urllib.request
 import time
+from collections import OrderedDict
+from functools import lru_cache
 from typing import Union
 from .text_gen import generate_text
+from .session import Session, line_key
+from .planner import Planner, INPLACE_COMMANDS, link_or_copy, media_arguments, new_token, file_token
+from .expressions import evaluate, ExpressionError
+from .workspace import Workspace
+from .governor import Governor
+from .profiles import get_profile, profile_args, palette_path, gif_args, convert_args
+from .output import OUTPUT_MODES, STREAMABLE_EXTENSIONS, move_file, read_file, stream_file, stream_ffmpeg
+from . import cache
+from .audio import AUDIO_COMMANDS, compose_audio, is_identity, audio_args, can_apply_in_process, apply_gain
 import shutil
-import tempfile
 class IscriptError(Exception):
     """Exception raised for invalid iscript commands."""
     pass
 class DownloadError(Exception):
     """Exception raised for download errors."""
     pass
+
+# Warm state shared by every parse call in a process, see MediaScript.serve
+PROBE_CACHE_SIZE = 256
+_probe_cache = OrderedDict()
+LUT_CACHE = "luts"
+
+@lru_cache(maxsize=None)
+def load_commands() -> tuple:
+  """
+  Loads the command definitions from commands.json once per process.
+  
+  :return: The command definitions.
+  :rtype: tuple
+  """
+  script_dir = os.path.dirname(__file__)
+  json_file_path = os.path.join(script_dir, '../data', 'commands.json')
+  with open(json_file_path, 'r') as file:
+    return tuple(load(file))
+def resolve_alias(cmd_name: str) -> str:
+  """Resolve command aliases to their actual command names."""
+  for cmd in load_commands():
+    if cmd["name"] == cmd_name:
+      return cmd_name
+    if "aliases" in cmd:
+      if cmd_name in cmd["aliases"]:
+        return cmd["name"]
+  return cmd_name
+@lru_cache(maxsize=256)
+def compile_script(code: str) -> tuple:
+  """
+  Splits a script into its lines and resolves their commands. Cached, so a script
+  that runs again is not parsed again.
+  
+  :param code: The iscript code.
+  :type code: str
+  :return: (line, command name, command definition, parameters) for every line, the
+    definition is None for unknown commands.
+  :rtype: tuple
+  """
+  compiled = []
+  for line in code.splitlines():
+    if not line.strip() or line.startswith("#"):
+      continue
+    cmd_name = resolve_alias(line.split()[0])
+    cmd_def = next((c for c in load_commands() if c["name"] == cmd_name), None)
+    parameters = line.split(maxsplit=len(cmd_def["args"])) if cmd_def else line.split()
+    compiled.append((line, cmd_name, cmd_def, tuple(parameters)))
+  return tuple(compiled)
+def compile_inputs(inputs: dict) -> tuple:
+  """
+  Turns inputs given as data into compiled loadfile lines.
+  
+  The parameters are built as they are instead of split from text, so a path
+  may hold spaces and nothing in it can add script lines.
+  
+  :param inputs: Media names mapped to file paths.
+  :type inputs: dict
+  :return: The compiled lines, like compile_script.
+  :rtype: tuple
+  :raises IscriptError: If a name is not a single word or a path is missing.
+  """
+  loadfile = next(c for c in load_commands() if c["name"] == "loadfile")
+  compiled = []
+  for name, path in (inputs or {}).items():
+    if not isinstance(name, str) or name.split() != [name]:
+      raise IscriptError(f"Invalid input name {name!r}, a media name is a single word.")
+    if not isinstance(path, str) or not os.path.isfile(path):
+      raise IscriptError(f"Input '{name}' is not a file: {path!r}")
+    compiled.append((f"loadfile {path} {name}", "loadfile", loadfile, ("loadfile", path, name)))
+  return tuple(compiled)
 def _download_logic(url, destination, chunk_size=8192):
     """The blocking logic that runs in a separate thread."""
     try:
@@ -93,20 +173,44 @@ async def generate_hue_ppm(hue:str, output_file:str):
     raise SystemError(f"Magick process failed with error: {stderr.decode()}")
   pass
   return f'{output_file}_{hue}.ppm'
+async def cached_hue_ppm(hue: float) -> str:
+  """
+  Returns the hue LUT for a hue, generating it once per user cache.
+  
+  :param hue: The hue of the ppm.
+  :type hue: float
+  :return: The path of the ppm in the LUT_CACHE cache.
+  :rtype: str
+  """
+  directory = cache.cache_dir(LUT_CACHE)
+  path = os.path.join(directory, f"hue_{hue}.ppm")
+  if not cache.lookup(path):
+    # Generate under a unique name, concurrent scripts may ask for the same hue
+    generated = await generate_hue_ppm(hue, cache.temporary(directory))
+    cache.store(generated, path)
+  return path
 def evaluate_expression(expression: str, variables: dict):
-    """Safely evaluates math, using the variables dict for lookups."""
-    # Combine math constants (pi, etc) with your custom variables
-    allowed_names = {k: v for k, v in vars(math).items() if not k.startswith("__")}
-    allowed_names.update(variables)
-    
+    """Safely evaluates math through the compiled expression cache, using the variables dict for lookups."""
     try:
-        # We use variables as the 'globals' for the eval context
-        return eval(expression, {"__builtins__": {}}, allowed_names)
-    except Exception as e:
-        # If it's not a math expression (like a string path), return as is
-        return expression
+        # Text that is not an expression (like a string path) is returned as is
+        return evaluate(expression, variables)
+    except ExpressionError as e:
+        raise IscriptError(str(e))
 async def get_media_info(filename: str, info_type: str):
     """Fetches metadata using ffprobe, specifically targeting video streams."""
+    # Commands replace files instead of editing them, so a changed media has a new inode or mtime
+    stat = os.stat(filename)
+    key = (filename, stat.st_ino, stat.st_size, stat.st_mtime_ns, info_type)
+    if key in _probe_cache:
+        _probe_cache.move_to_end(key)
+        return _probe_cache[key]
+    value = await probe_media_info(filename, info_type)
+    _probe_cache[key] = value
+    if len(_probe_cache) > PROBE_CACHE_SIZE:
+        _probe_cache.popitem(last=False)
+    return value
+async def probe_media_info(filename: str, info_type: str):
+    """Runs ffprobe for get_media_info."""
     # Duration is in 'format', width/height are in 'streams'
     is_duration = info_type == "duration"
     
@@ -134,7 +238,7 @@ async def get_media_info(filename: str, info_type: str):
         print(f"Warning: Could not find {info_type} for {filename}")
         return 0
 
-async def parse(code:str,playoutput:bool=False):
+async def parse(code:str,playoutput:bool=False,session:Session=None,memory_budget:int=0,disk_budget:int=None,output:str="files",destination:str=None,progress=None,limits:dict=None,inputs:dict=None):
   """
   Docstring for parse
   
@@ -142,65 +246,208 @@ async def parse(code:str,playoutput:bool=False):
   :type code: str
   :param playoutput: Whether to play the output after processing.
   :type playoutput: bool
+  :param session: Keeps the workspace between calls so an edited script resumes from its first changed line.
+  :type session: Session
+  :param memory_budget: Bytes of intermediates to keep on tmpfs before spilling to disk. Not used with a session.
+  :type memory_budget: int
+  :param disk_budget: Bytes of intermediates allowed on disk, the script stops with WorkspaceFullError past it.
+  :type disk_budget: int
+  :param output: How attachments are returned. "files" moves them to destination or the current directory,
+    "bytes" and "memoryview" return their contents under "data", and "stream" returns an async iterator of
+    chunks under "stream". The stream owns the intermediates until it is exhausted or closed.
+  :type output: str
+  :param destination: The path to move the rendered file to, when output is "files".
+  :type destination: str
+  :param progress: Called with {"line", "total", "command"} before each line runs.
+  :type progress: callable
+  :param limits: Resource limits for inputs and for the whole script, see governor.DEFAULT_LIMITS.
+    Over-limit inputs are normalized or rejected with BudgetExceededError. None disables the governor.
+  :type limits: dict
+  :param inputs: Media names mapped to files, loaded before the script runs as if by loadfile.
+    Paths are taken as they are, spaces included.
+  :type inputs: dict
   """
+  if output not in OUTPUT_MODES:
+    raise IscriptError(f"Unknown output mode '{output}', expected one of {', '.join(OUTPUT_MODES)}.")
+  governor = Governor(limits) if limits is not None else None
   start_time = time.time()
   
   # Save original directory before any changes
   original_dir = os.getcwd()
   
-  # Create a temporary directory for processing
-  temp_dir = tempfile.mkdtemp()
+  # Place intermediates in a temporary workspace, or in the session workspace
+  # Session snapshots hard link the intermediates, so they all stay in its directory
+  if session:
+    workspace = Workspace(session.workspace, disk_budget=disk_budget)
+  else:
+    workspace = Workspace(memory_budget=memory_budget, disk_budget=disk_budget)
+  # Set once a stream takes over the intermediates
+  streaming = False
   
   try:
-    # Change to temp directory for all processing
-    os.chdir(temp_dir)
-    
-    script_dir = os.path.dirname(__file__)
-    json_file_path = os.path.join(script_dir, '../data', 'commands.json')
-    with open(json_file_path, 'r') as file:
-      commands = load(file)
-      command_names = []
-      for c in commands:
-        command_names.append(c["name"])
+    commands = load_commands()
+    command_names = [c["name"] for c in commands]
     variables = {}
     attachments = []
     medias = []
+    planner = Planner()
     def get_media_by_name(name:str):
       for media in medias:
         if media["name"] == name:
           return media["file"]
-    def resolve_alias(cmd_name: str):
-      """Resolve command aliases to their actual command names."""
-      for cmd in commands:
-        if cmd["name"] == cmd_name:
-          return cmd_name
-        if "aliases" in cmd:
-          if cmd_name in cmd["aliases"]:
-            return cmd["name"]
-      return cmd_name
     def rename_new_and_delete_old(new:str,old:str):
       try:
         os.remove(old)
         os.rename(new, old)
       except Exception as e:
         print(f"An error occurred while renaming and deleting files: {e}")
+    async def flush_audio(media: dict):
+      """
+      Runs the audio commands deferred on a media as a single stage.
+
+      A failure stops the script, rendering the media without its audio edits would hide it.
+      """
+      chain = media.pop("audio", None)
+      if not chain or is_identity(chain):
+        return
+      step = planner.step_for(media, "audio", (chain["pitch"], chain["tempo"], chain["gain"]))
+      if planner.reuse(step, medias):
+        return
+      input_media = media["file"]
+      output_media = workspace.derived("audio", input_media)
+      try:
+        if can_apply_in_process(input_media, chain):
+          await asyncio.to_thread(apply_gain, input_media, output_media, chain["gain"])
+        else:
+          await ffmpeg_process(input_media, output_media, audio_args(chain))
+        rename_new_and_delete_old(output_media, input_media)
+        planner.record(step, medias)
+      except Exception as e:
+        print(f"FFmpeg Error: {e}")
+        raise
+    def pending_audio(media: dict) -> dict:
+      """Takes the deferred audio of a media for the final encode to run, None when there is nothing to do."""
+      chain = media.pop("audio", None) if media else None
+      return None if not chain or is_identity(chain) else chain
+    async def encode(attachment: dict) -> str:
+      """Encodes a render with its profile, returning the encoded file."""
+      profile = attachment["profile"]
+      input_media = attachment["file"]
+      media = next((m for m in medias if m["file"] == input_media), None)
+      # The deferred audio runs in the profile encode, so the output is encoded once
+      chain = pending_audio(media)
+      # The render name comes from the script, only its last component names a file in the workspace
+      output_media = workspace.sibling(input_media, f"{os.path.basename(attachment['name']) or 'render'}{profile['extension']}")
+      if output_media == input_media:
+        output_media = workspace.derived("render", input_media)
+      if profile["extension"] != ".gif":
+        await ffmpeg_process(input_media, output_media, profile_args(profile, chain=chain))
+        return output_media
+      palette = None
+      if media:
+        # GIF palettes only depend on the content and its timing, reuse them across renders
+        palette = palette_path(new_token(media["token"], "tempo", chain["tempo"]) if chain else media["token"], profile)
+      if palette and cache.lookup(palette):
+        await ffmpeg_process(input_media, output_media, gif_args(profile, palette=palette, chain=chain))
+      elif palette:
+        generated = workspace.sibling(input_media, os.path.basename(palette))
+        await ffmpeg_process(input_media, output_media, gif_args(profile, save_palette=generated, chain=chain))
+        if os.path.exists(generated):
+          cache.store(generated, palette)
+      else:
+        await ffmpeg_process(input_media, output_media, gif_args(profile, chain=chain))
+      return output_media
+    async def govern(media: dict, source: str = None):
+      """Probes a new media once and fits it to the limits."""
+      if not os.path.exists(media["file"]):
+        # The load failed and was reported already
+        return
+      _, args = await governor.admit(media["file"], source)
+      if args:
+        output_media = workspace.derived("normalize", media["file"])
+        await ffmpeg_process(media["file"], output_media, args)
+        rename_new_and_delete_old(output_media, media["file"])
+        media["token"] = new_token(media["token"], "normalize", *args)
+      governor.check_size(media["file"])
     def resolve_path(file_path: str) -> str:
       """Convert relative paths to absolute paths using original_dir."""
       if os.path.isabs(file_path):
         return file_path
       return os.path.join(original_dir, file_path)
-    for line in code.splitlines():
-      if not line.strip() or line.startswith("#"):
-          continue
+    compiled = compile_inputs(inputs) + compile_script(code)
+    lines = [line for line, _, _, _ in compiled]
+    start = 0
+    if session:
+      def evaluate_set(line: str, values: dict):
+        """Applies a set line to values, used to tell equivalent edits apart from real ones."""
+        parts = line.split()
+        if resolve_alias(parts[0]) != "set":
+          return None
+        values[parts[1]] = evaluate_expression(" ".join(parts[2:]), values)
+        return values
+      keys = [line_key(line, original_dir, parameters) for line, _, _, parameters in compiled]
+      start = session.resume_point(keys, evaluate_set)
+      variables, medias = session.restore(start, keys)
+    estimated_cost = None
+    if governor:
+      # Refuse scripts over budget before any FFmpeg job runs
+      estimated_cost = await governor.check_script(compiled, resolve_path)
+    # Index of the last line reading each media, intermediates are deleted once it has run
+    # A session keeps every media, an edited script may read them again
+    last_use = {}
+    keep = None
+    for index, (line, _, cmd_def, parameters) in enumerate(compiled):
+      if not cmd_def:
+        continue
+      if keep is None and len(parameters) > 1 and cmd_def["name"] in ("load", "loadfile", "tti"):
+        # Without a render the first loaded media is the output
+        if cmd_def["name"] == "tti":
+          keep = parameters[1]
+        else:
+          keep = parameters[2] if len(parameters) > 2 else os.path.basename(urlparse(parameters[1]).path)
+      for position in media_arguments(cmd_def):
+        if position < len(parameters):
+          last_use[parameters[position]] = index
+    if any(cmd_name == "render" for _, cmd_name, _, _ in compiled):
+      keep = None
+    def reclaim(index: int):
+      """Deletes the medias no line from index on reads."""
+      if not session:
+        for media in [m for m in medias if last_use.get(m["name"], -1) < index and m["name"] != keep]:
+          medias.remove(media)
+          workspace.release(media["file"])
+      planner.prune(medias)
+      moved = workspace.settle(medias)
+      planner.relocate(moved)
+    for index in range(start, len(lines)):
+      line = lines[index]
+      if session:
+        session.record(index, variables, medias)
+      reclaim(index)
       parts = line.split()
-      cmd_name = parts[0]
-      # Resolve alias to actual command name
-      cmd_name = resolve_alias(cmd_name)
+      _, cmd_name, cmd_def, parameters = compiled[index]
       if cmd_name not in command_names:
           raise IscriptError(f"{cmd_name} is not a valid command.")
-      cmd_def = next((c for c in commands if c["name"] == cmd_name), None)
-      num_args = len(cmd_def["args"])
-      parameters = line.split(maxsplit=num_args)
+      parameters = list(parameters)
+      if progress:
+        progress({"line": index, "total": len(lines), "command": cmd_name})
+      loaded = len(medias)
+      # Run the deferred audio of every media this line reads, unless the line only adds to it
+      # A streamed render or a render with a profile runs it in the final encode instead
+      for position in media_arguments(cmd_def):
+        if position >= len(parameters) or (position == 1 and (cmd_name in AUDIO_COMMANDS or cmd_name == "clone")):
+          continue
+        if position == 1 and cmd_name == "render" and (output == "stream" or len(parameters) > 3):
+          continue
+        media = next((m for m in medias if m["name"] == parameters[position]), None)
+        if media and media.get("audio"):
+          await flush_audio(media)
+      step = None
+      if cmd_name in INPLACE_COMMANDS:
+        # Skip the step if another media already computed it from the same content
+        step = planner.step(cmd_def, parameters, medias, lambda p: evaluate_expression(p, variables))
+        if step and planner.reuse(step, medias):
+          continue
       if cmd_name == "set":
         # set var_name expression
         var_name = parts[1]
@@ -225,12 +472,14 @@ async def parse(code:str,playoutput:bool=False):
           filename = os.path.basename(parsed_path)
           if not filename:
             filename = f"video_{int(time.time())}.mp4"
+          filename = workspace.path(filename)
               
           # Now actually call the download
           await download_video_async(url, filename)
               
-          friendly_name = parameters[2] if len(parameters) > 2 else filename
-          medias.append({"file": filename, "name": friendly_name})
+          friendly_name = parameters[2] if len(parameters) > 2 else os.path.basename(filename)
+          # The content behind a URL can change, so the token comes from what was downloaded
+          medias.append({"file": filename, "name": friendly_name, "token": file_token(filename)})
         except Exception as e:
           print(str(e))
       elif cmd_name == "loadfile":
@@ -240,11 +489,20 @@ async def parse(code:str,playoutput:bool=False):
               
           # Resolve the file path to absolute path using original directory
           file_path = resolve_path(parameters[1])
+          stat = os.stat(file_path)
+          token = new_token("loadfile", file_path, stat.st_size, stat.st_mtime_ns)
           # clone file so that all previous data is not erased
-          dest_filename = f"loaded_{int(time.time())}_{os.path.basename(file_path)}"
-          shutil.copy2(file_path, dest_filename)
+          filename = f"loaded_{int(time.time())}_{len(medias)}_{os.path.basename(file_path)}"
+          same_file = next((m for m in medias if m["token"] == token and os.path.exists(m["file"])), None)
+          if same_file:
+            # The same file was loaded before, share its copy
+            dest_filename = workspace.sibling(same_file["file"], filename)
+            link_or_copy(same_file["file"], dest_filename)
+          else:
+            dest_filename = workspace.path(filename, stat.st_size)
+            shutil.copy2(file_path, dest_filename)
           friendly_name = parameters[2] if len(parameters) > 2 else os.path.basename(file_path)
-          medias.append({"file": dest_filename, "name": friendly_name})
+          medias.append({"file": dest_filename, "name": friendly_name, "token": token})
         except Exception as e:
           print(str(e))
       elif cmd_name == "tti":
@@ -258,17 +516,17 @@ async def parse(code:str,playoutput:bool=False):
           bounds = float(evaluate_expression(parts[3], variables))
           color = parameters[4]
           text = parameters[5]
-          filename = f"tti_{m_name}_{int(time.time())}.png"
+          filename = workspace.path(f"tti_{m_name}_{int(time.time())}.png")
           generate_text(text,filename,size,color,bounds,"center")
           friendly_name = parameters[1] if len(parameters) > 1 else filename
-          medias.append({"file": filename, "name": m_name})
+          medias.append({"file": filename, "name": m_name, "token": new_token("tti", size, bounds, color, text)})
       elif cmd_name == "invert":
         # get filename
         input_media = get_media_by_name(parameters[1])
         if not input_media:
           raise IscriptError(f"Media '{parameters[1]}' not found for invert.")
               
-        output_media = f"invert_{input_media}"
+        output_media = workspace.derived("invert", input_media)
         # ffmpeg args
         args = ["-vf", "negate"]
               
@@ -292,13 +550,18 @@ async def parse(code:str,playoutput:bool=False):
               
           # Create a unique filename for the copy
           file_ext = os.path.splitext(original_file)[1]
-          new_filename = f"clone_{int(time.time())}_{new_name}{file_ext}"
+          new_filename = workspace.sibling(original_file, f"clone_{int(time.time())}_{new_name}{file_ext}")
           
           try:
-              # Physically copy the file
-              shutil.copy2(original_file, new_filename)
+              # Hard link the file, commands replace files instead of editing them so the clone stays independent
+              link_or_copy(original_file, new_filename)
               # Add to the medias list
-              medias.append({"file": new_filename, "name": new_name})
+              original = next(m for m in medias if m["name"] == original_name)
+              clone = {"file": new_filename, "name": new_name, "token": original["token"]}
+              if original.get("audio"):
+                # Deferred audio commands carry over to the clone
+                clone["audio"] = original["audio"]
+              medias.append(clone)
           except Exception as e:
               print(f"Cloning Error: {e}")
       elif cmd_name == "join":
@@ -311,7 +574,7 @@ async def parse(code:str,playoutput:bool=False):
           raise IscriptError(f"Media '{parameters[1]}' not found for reverse.")
         if not input_media2:
           raise IscriptError(f"Media '{parameters[2]}' not found for reverse.")
-        output_media = f"aputmix_{input_media}"
+        output_media = workspace.derived("aputmix", input_media)
         # ffmpeg args
         if parameters[3].lower() == "true":
           args = ["-i",input_media2,"-filter_complex", f"[0:v][1:v]vstack=inputs=2[v];[0:a][1:a]amix=2:duration=shortest[a]","-map","[v]","-map","[a]"]
@@ -350,11 +613,10 @@ async def parse(code:str,playoutput:bool=False):
           if not input_file:
               raise IscriptError(f"Media '{media_name}' not found for conversion.")
 
-          output_file = f"conv_{int(time.time())}{target_ext}"
+          output_file = workspace.path(f"conv_{int(time.time())}{target_ext}", os.path.getsize(input_file))
           
-          # FFmpeg handles the conversion automatically based on the output extension
-          # We use -q:a 0 for variable bitrate audio or -preset fast for video
-          args = ["-q:a", "0", "-preset", "fast"]
+          # FFmpeg picks the container from the output extension, the encoder settings come from profiles
+          args = convert_args(target_ext)
           
           try:
               await ffmpeg_process(input_file, output_file, args)
@@ -362,6 +624,9 @@ async def parse(code:str,playoutput:bool=False):
               for m in medias:
                   if m["name"] == media_name:
                       m["file"] = output_file
+                      m["token"] = new_token(m["token"], "convert", mime_type)
+              # The original is no longer read by anything
+              workspace.release(input_file)
           except Exception as e:
               print(f"Conversion Error: {e}")
       
@@ -380,7 +645,7 @@ async def parse(code:str,playoutput:bool=False):
           if not base_file or not top_file:
               raise IscriptError(f"Media not found for overlay: {base_name} or {top_name}")
               
-          output_file = f"overlay_{int(time.time())}.mp4"
+          output_file = workspace.sibling(base_file, f"overlay_{int(time.time())}.mp4")
           
           # FFmpeg command: [0:v][1:v]overlay=x:y
           args = [
@@ -406,7 +671,7 @@ async def parse(code:str,playoutput:bool=False):
           if not input_media:
               raise IscriptError(f"Media not found for rotate: {parameters[1]}")
 
-          output_file = f"rotate_{int(time.time())}.mp4"
+          output_file = workspace.sibling(input_media, f"rotate_{int(time.time())}.mp4")
 
           # FFmpeg command: -vf "rotate=PI/4:ow='ceil(iwcos(PI/4)+ihsin(PI/4))':oh='ceil(iwsin(PI/4)+ihcos(PI/4))'" ./output/output.mp4
           widths = ":ow='ceil(iw*cos(PI/4)+ih*sin(PI/4))':oh='ceil(iw*sin(PI/4)+ih*cos(PI/4))'" if not crop else ""
@@ -426,27 +691,10 @@ async def parse(code:str,playoutput:bool=False):
         if not input_media:
           raise IscriptError(f"Media '{parameters[1]}' not found for reverse.")
             
-        output_media = f"reversed_{input_media}"
+        output_media = workspace.derived("reversed", input_media)
         # ffmpeg args
         args = ["-vf", "reverse", "-af", "areverse"]
             
-        try:
-          # call ffmpeg
-          await ffmpeg_process(input_media, output_media, args)
-          rename_new_and_delete_old(output_media, input_media)
-        except Exception as e:
-          print(f"FFmpeg Error: {e}")
-          break
-      elif cmd_name == "speed":
-        # get filename
-        input_media = get_media_by_name(parameters[1])
-        if not input_media:
-          raise IscriptError(f"Media '{parameters[1]}' not found for reverse.")
-            
-        output_media = f"speed_{input_media}"
-        # ffmpeg args
-        args = ["-vf", f"setpts=1/{parameters[2]}*PTS,fps=30", "-af", f"rubberband=tempo={parameters[2]}:formant=712923000"]
-            
         try:
           # call ffmpeg
           await ffmpeg_process(input_media, output_media, args)
@@ -460,10 +708,10 @@ async def parse(code:str,playoutput:bool=False):
         if not input_media:
           raise IscriptError(f"Media '{parameters[1]}' not found for hueshifthsv.")
             
-        output_media = f"hueshifthsv_{input_media}"
-        output_hue = f"hue_{int(time.time())}"
-        hue = await generate_hue_ppm(float(parameters[2]),output_hue)
-        args = ["-vf", f"movie={hue},[in]haldclut,format=yuv420p"]
+        output_media = workspace.derived("hueshifthsv", input_media)
+        hue = await cached_hue_ppm(float(parameters[2]))
+        # The LUT is a second input rather than a movie= source, so its path is never parsed as filter graph syntax
+        args = ["-i", hue, "-filter_complex", "[0:v][1:v]haldclut,format=yuv420p"]
             
         try:
           # call ffmpeg
@@ -478,7 +726,7 @@ async def parse(code:str,playoutput:bool=False):
         if not input_media:
           raise IscriptError(f"Media '{parameters[1]}' not found for swirl.")
         w, h = await get_media_info(input_media, "width"), await get_media_info(input_media, "height")
-        output_media = f"swirl_{input_media}"
+        output_media = workspace.derived("swirl", input_media)
         swirl_value = float(evaluate_expression(parameters[2],variables))
         # ffmpeg args
         args = ["-vf", f"format=yuv444p,scale={h}:{h},geq='p(W*0.5+(hypot(X-W*0.5,Y-H*0.5)+1e-6)*cos((atan2(Y-H*0.5,X-W*0.5))+(({swirl_value})/180*PI)*(if(lt(hypot(X-W*0.5,Y-H*0.5)+1e-6,min(W,H)*0.5),1-(hypot(X-W*0.5,Y-H*0.5)+1e-6)/(min(W,H)*0.5),0)^2)),H*0.5+(hypot(X-W*0.5,Y-H*0.5)+1e-6)*sin((atan2(Y-H*0.5,X-W*0.5))+(({swirl_value})/180*PI)*(if(lt(hypot(X-W*0.5,Y-H*0.5)+1e-6,min(W,H)*0.5),1-(hypot(X-W*0.5,Y-H*0.5)+1e-6)/(min(W,H)*0.5),0)^2)))',scale={w}:{h},setsar=1:1,format=yuv420p"]
@@ -496,9 +744,9 @@ async def parse(code:str,playoutput:bool=False):
         if not input_media:
           raise IscriptError(f"Media '{parameters[1]}' not found for explode.")
         w, h = await get_media_info(input_media, "width"), await get_media_info(input_media, "height")
-        output_media = f"explode_{input_media}"
+        output_media = workspace.derived("explode", input_media)
         try:
-          float(evaluate_expression(parameters[2], variables))
+          explode_value = float(evaluate_expression(parameters[2], variables))
         except IndexError: # if 2nd parameter does not exist or is invalid, default to 1
           explode_value = 1
         # ffmpeg args
@@ -517,7 +765,7 @@ async def parse(code:str,playoutput:bool=False):
         if not input_media:
           raise IscriptError(f"Media '{parameters[1]}' not found for flip.")
             
-        output_media = f"flip_{input_media}"
+        output_media = workspace.derived("flip", input_media)
         # ffmpeg args
         args = ["-vf","vflip"]
         try:
@@ -533,7 +781,7 @@ async def parse(code:str,playoutput:bool=False):
         if not input_media:
           raise IscriptError(f"Media '{parameters[1]}' not found for flop.")
             
-        output_media = f"flop_{input_media}"
+        output_media = workspace.derived("flop", input_media)
         # ffmpeg args
         args = ["-vf","hflip"]
         try:
@@ -549,7 +797,7 @@ async def parse(code:str,playoutput:bool=False):
         if not input_media:
           raise IscriptError(f"Media '{parameters[1]}' not found for reverse.")
             
-        output_media = f"haah_{input_media}"
+        output_media = workspace.derived("haah", input_media)
         # ffmpeg args
         args = ["-vf","crop=iw/2:ih:0:0,split[left][tmp];[tmp]hflip[right];[left][right]hstack"]
         try:
@@ -565,7 +813,7 @@ async def parse(code:str,playoutput:bool=False):
         if not input_media:
           raise IscriptError(f"Media '{parameters[1]}' not found for reverse.")
             
-        output_media = f"waaw_{input_media}"
+        output_media = workspace.derived("waaw", input_media)
         # ffmpeg args
         args = ["-vf","crop=iw/2:ih:iw/2:0,split[right][tmp];[tmp]hflip[left];[left][right]hstack"]
         try:
@@ -581,7 +829,7 @@ async def parse(code:str,playoutput:bool=False):
         if not input_media:
           raise IscriptError(f"Media '{parameters[1]}' not found for reverse.")
             
-        output_media = f"woow_{input_media}"
+        output_media = workspace.derived("woow", input_media)
         # ffmpeg args
         args = ["-vf","crop=iw:ih/2:0:0,split[top][tmp];[tmp]vflip[bottom];[top][bottom]vstack"]
         try:
@@ -597,7 +845,7 @@ async def parse(code:str,playoutput:bool=False):
         if not input_media:
           raise IscriptError(f"Media '{parameters[1]}' not found for reverse.")
             
-        output_media = f"hooh_{input_media}"
+        output_media = workspace.derived("hooh", input_media)
         # ffmpeg args
         args = ["-vf","crop=iw:ih/2:0:ih/2,split[bottom][tmp];[tmp]vflip[top];[top][bottom]vstack"]
         try:
@@ -613,7 +861,7 @@ async def parse(code:str,playoutput:bool=False):
         if not input_media:
           raise IscriptError(f"Media '{parameters[1]}' not found for reverse.")
             
-        output_media = f"contrast_{input_media}"
+        output_media = workspace.derived("contrast", input_media)
         contrast = float(evaluate_expression(parameters[2],variables))
         # ffmpeg args
         args = ["-vf", f"eq=contrast={contrast}"]
@@ -631,7 +879,7 @@ async def parse(code:str,playoutput:bool=False):
         if not input_media:
           raise IscriptError(f"Media '{parameters[1]}' not found for brightness.")
             
-        output_media = f"brightness_{input_media}"
+        output_media = workspace.derived("brightness", input_media)
         brightness = float(evaluate_expression(parameters[2],variables))
         # ffmpeg args
         args = ["-vf", f"eq=brightness={max(brightness, 0)}"]
@@ -649,7 +897,7 @@ async def parse(code:str,playoutput:bool=False):
         if not input_media:
           raise IscriptError(f"Media '{parameters[1]}' not found for reverse.")
 
-        output_media = f"darken_{input_media}"
+        output_media = workspace.derived("darken", input_media)
         brightness = -float(evaluate_expression(parameters[2],variables))
         # ffmpeg args
         args = ["-vf", f"eq=brightness={max(brightness, -100)}"]
@@ -667,7 +915,7 @@ async def parse(code:str,playoutput:bool=False):
         if not input_media:
           raise IscriptError(f"Media '{parameters[1]}' not found for blur.")
             
-        output_media = f"blur_{input_media}"
+        output_media = workspace.derived("blur", input_media)
         scale = float(evaluate_expression(parameters[2],variables))
         # ffmpeg args
         args = ["-vf", f"boxblur={scale}"]
@@ -679,60 +927,13 @@ async def parse(code:str,playoutput:bool=False):
         except Exception as e:
           print(f"FFmpeg Error: {e}")
           break
-      elif cmd_name == "volume":
-        # get filename
-        input_media = get_media_by_name(parameters[1])
-        if not input_media:
-          raise IscriptError(f"Media '{parameters[1]}' not found for reverse.")
-            
-        output_media = f"volume_{input_media}"
-        vol = float(evaluate_expression(parameters[2],variables))
-        # ffmpeg args
-        args = ["-af", f"volume={vol}"]
-            
-        try:
-          # call ffmpeg
-          await ffmpeg_process(input_media, output_media, args)
-          rename_new_and_delete_old(output_media, input_media)
-        except Exception as e:
-          print(f"FFmpeg Error: {e}")
-          break
-      elif cmd_name == "volume":
-        # get filename
-        input_media = get_media_by_name(parameters[1])
-        if not input_media:
-          raise IscriptError(f"Media '{parameters[1]}' not found for reverse.")
-            
-        output_media = f"volume_{input_media}"
-        vol = float(evaluate_expression(parameters[2],variables))
-        # ffmpeg args
-        args = ["-af", f"volume={vol}"]
-            
-        try:
-          # call ffmpeg
-          await ffmpeg_process(input_media, output_media, args)
-          rename_new_and_delete_old(output_media, input_media)
-        except Exception as e:
-          print(f"FFmpeg Error: {e}")
-          break
-      elif cmd_name == "audiopitch":
-        # get filename
-        input_media = get_media_by_name(parameters[1])
-        if not input_media:
-          raise IscriptError(f"Media '{parameters[1]}' not found for reverse.")
-            
-        output_media = f"apitch_{input_media}"
-        pitch = float(evaluate_expression(parameters[2],variables))
-        # ffmpeg args
-        args = ["-af", f"rubberband=pitch={pitch}:formant=712923000"]
-            
-        try:
-          # call ffmpeg
-          await ffmpeg_process(input_media, output_media, args)
-          rename_new_and_delete_old(output_media, input_media)
-        except Exception as e:
-          print(f"FFmpeg Error: {e}")
-          break
+      elif cmd_name in AUDIO_COMMANDS:
+        # audiopitch, speed and volume are composed here and run as one stage when the media is next read
+        if not get_media_by_name(parameters[1]):
+          raise IscriptError(f"Media '{parameters[1]}' not found for {cmd_name}.")
+        media = next(m for m in medias if m["name"] == parameters[1])
+        value = float(evaluate_expression(parameters[2],variables))
+        media["audio"] = compose_audio(media.get("audio"), cmd_name, value)
       elif cmd_name == "audioputmix":
         # get filename
         input_media = get_media_by_name(parameters[1])
@@ -743,7 +944,7 @@ async def parse(code:str,playoutput:bool=False):
           raise IscriptError(f"Media '{parameters[1]}' not found for reverse.")
         if not input_media2:
           raise IscriptError(f"Media '{parameters[2]}' not found for reverse.")
-        output_media = f"aputmix_{input_media}"
+        output_media = workspace.derived("aputmix", input_media)
         # ffmpeg args
         args = ["-i",input_media2,"-filter_complex", f"[0:a][1:a]amix=2:duration=shortest[a]","-map","0:v","-map","[a]"]
             
@@ -757,26 +958,66 @@ async def parse(code:str,playoutput:bool=False):
       
       elif cmd_name == "render":
         media = get_media_by_name(parameters[1])
-        attachments.append({"file":media,"name":parameters[2] or parameters[0]})
+        profile = None
+        if len(parameters) > 3:
+          try:
+            profile = get_profile(parameters[3])
+          except KeyError as e:
+            raise IscriptError(e.args[0])
+        attachments.append({"file":media,"name":parameters[2] or parameters[0],"profile":profile})
         break
+      if governor and cmd_name in ("load", "loadfile", "tti") and len(medias) > loaded:
+        await govern(medias[-1], resolve_path(parameters[1]) if cmd_name == "loadfile" else None)
+      if step:
+        planner.record(step, medias)
     # if no render command found, return first media loaded in attachments
     if not attachments:
       if medias:
         first_media = medias[0]
+        await flush_audio(first_media)
         attachments.append({"file":first_media["file"],"name":first_media["name"]})
+    workspace.settle(medias)
     
     end_time = time.time()
     
-    # Copy final attachments to original directory
     final_attachments = []
     for attachment in attachments:
       temp_file = attachment["file"]
-      # Create output filename in original directory
-      final_filename = os.path.join(original_dir, os.path.basename(temp_file))
-      shutil.copy2(temp_file, final_filename)
-      final_attachments.append({"file": final_filename, "name": attachment["name"]})
+      profile = attachment.get("profile")
+      # A streamed MP4 profile is encoded straight to the stream below
+      if profile and not (output == "stream" and profile["extension"] in STREAMABLE_EXTENSIONS):
+        temp_file = await encode(attachment)
+      if output == "files":
+        # Move final attachments to the destination or the original directory, the workspace is removed anyway
+        final_filename = destination or original_dir
+        if os.path.isdir(final_filename):
+          final_filename = os.path.join(final_filename, os.path.basename(temp_file))
+        move_file(temp_file, final_filename)
+        final_attachments.append({"file": final_filename, "name": attachment["name"]})
+      elif output in ("bytes", "memoryview"):
+        data = read_file(temp_file, as_memoryview=output == "memoryview")
+        final_attachments.append({"name": attachment["name"], "data": data})
+      elif profile and profile["extension"] in STREAMABLE_EXTENSIONS:
+        media = next((m for m in medias if m["file"] == temp_file), None)
+        # The profile encode is the last FFmpeg run and takes the deferred audio, stream its output as it is encoded
+        stream = stream_ffmpeg(temp_file, profile_args(profile, streaming=True, chain=pending_audio(media)), cleanup=workspace.close)
+        final_attachments.append({"name": attachment["name"], "stream": stream})
+        streaming = True
+      else:
+        media = next((m for m in medias if m["file"] == temp_file), None)
+        chain = media.pop("audio", None) if media else None
+        if chain and not is_identity(chain) and os.path.splitext(temp_file)[1].lower() in STREAMABLE_EXTENSIONS:
+          # The deferred audio stage is the last FFmpeg run, stream its output as it is encoded
+          stream = stream_ffmpeg(temp_file, audio_args(chain), cleanup=workspace.close)
+        else:
+          if chain:
+            media["audio"] = chain
+            await flush_audio(media)
+          stream = stream_file(temp_file, cleanup=workspace.close)
+        final_attachments.append({"name": attachment["name"], "stream": stream})
+        streaming = True
     
-    if playoutput:
+    if playoutput and output == "files":
       for attachment in final_attachments:
         # os.startfile(attachment["file"])
         # use ffplay to play the file
@@ -789,12 +1030,18 @@ async def parse(code:str,playoutput:bool=False):
         )
         await process.communicate()
     
-    return {"time":end_time - start_time,"attachments":final_attachments}
+    results = {"time":end_time - start_time,"attachments":final_attachments,"workspace":workspace.report()}
+    if session:
+      results["resumed_from"] = start
+    if governor:
+      results["estimated_cost"] = estimated_cost
+    return results
   
   finally:
-    # Always clean up: return to original directory and remove temp directory
-    os.chdir(original_dir)
-    shutil.rmtree(temp_dir, ignore_errors=True)
+    # Always clean up the intermediates, unless a stream still reads them
+    # A session keeps its workspace until it is closed
+    if not streaming:
+      workspace.close()
 
 def get_commands() -> list:
   """
@@ -803,11 +1050,7 @@ def get_commands() -> list:
   :return: The list of commands.
   :rtype: list
   """
-  script_dir = os.path.dirname(__file__)
-  json_file_path = os.path.join(script_dir, '../data', 'commands.json')
-  with open(json_file_path, 'r') as file:
-    commands = load(file)
-  return commands
+  return list(load_commands())
 def commandlength():
   """
   Returns the number of available commands.
@@ -815,11 +1058,7 @@ def commandlength():
   :return: The number of commands.
   :rtype: int
   """
-  script_dir = os.path.dirname(__file__)
-  json_file_path = os.path.join(script_dir, '../data', 'commands.json')
-  with open(json_file_path, 'r') as file:
-    commands = load(file)
-  return len(commands)
+  return len(load_commands())
 def get_commands() -> list:
   """
   Returns the list of available commands.
@@ -827,11 +1066,7 @@ def get_commands() -> list:
   :return: The list of commands.
   :rtype: list
   """
-  script_dir = os.path.dirname(__file__)
-  json_file_path = os.path.join(script_dir, '../data', 'commands.json')
-  with open(json_file_path, 'r') as file:
-    commands = load(file)
-  return commands
+  return list(load_commands())
 def commandlength():
   """
   Returns the number of available commands.
@@ -839,8 +1074,4 @@ def commandlength():
   :return: The number of commands.
   :rtype: int
   """
-  script_dir = os.path.dirname(__file__)
-  json_file_path = os.path.join(script_dir, '../data', 'commands.json')
-  with open(json_file_path, 'r') as file:
-    commands = load(file)
-  return len(commands)
\ No newline at end of file
+  return len(load_commands())
\ No newline at end of file
@@ -0,0 +1,182 @@
+import hashlib
+import os
+import shutil
+
+# Commands that read their media and replace it with the processed result.
+# Only these take part in common-subexpression elimination.
+INPLACE_COMMANDS = {
+    "invert", "join", "overlay", "rotate", "reverse", "hueshifthsv",
+    "swirl", "explode", "flip", "flop", "haah", "waaw", "woow", "hooh",
+    "contrast", "brightness", "darken", "blur", "audioputmix",
+}
+
+def link_or_copy(source: str, destination: str):
+    """
+    Hard links source to destination, copying when linking is not possible.
+
+    Commands never edit a file in place, they write a new file and rename it over
+    the old one, so a hard link behaves like a copy that costs nothing until one
+    side changes.
+
+    :param source: The existing file.
+    :type source: str
+    :param destination: The new file.
+    :type destination: str
+    """
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+def new_token(*parts) -> str:
+    """
+    Builds a content token from the steps that produced a media.
+
+    Two medias with the same token hold the same content.
+
+    :return: The token.
+    :rtype: str
+    """
+    return hashlib.sha1(repr(parts).encode()).hexdigest()[:16]
+
+def file_token(path: str) -> str:
+    """Builds the content token of a file from its bytes, for inputs whose name says nothing about their content."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return new_token("file", digest.hexdigest())
+
+def media_arguments(cmd_def: dict) -> list:
+    """
+    Returns the positions of the arguments of a command that name a media.
+
+    :param cmd_def: The command definition from commands.json.
+    :type cmd_def: dict
+    :return: The 1-based parameter positions.
+    :rtype: list
+    """
+    return [i + 1 for i, arg in enumerate(cmd_def["args"]) if "media" in arg["name"]]
+
+class Planner:
+    """
+    Detects identical steps across medias and computes them once.
+
+    Every media carries a token describing its content. A step is keyed by the
+    token of its input, the command, the evaluated arguments and the tokens of any
+    other medias it reads. When a step runs while another media still holds the
+    same input token, the result is kept so the other media can take it with a
+    hard link instead of running FFmpeg again.
+    """
+    def __init__(self):
+        self.results = {}
+
+    def step(self, cmd_def: dict, parameters: list, medias: list, evaluate):
+        """
+        Describes an in-place step before it runs.
+
+        :param cmd_def: The command definition.
+        :type cmd_def: dict
+        :param parameters: The split script line.
+        :type parameters: list
+        :param medias: The current medias.
+        :type medias: list
+        :param evaluate: Evaluates an argument against the current variables.
+        :type evaluate: callable
+        :return: The step, or None if it reads a media that does not exist.
+        :rtype: dict
+        """
+        positions = media_arguments(cmd_def)
+        inputs = []
+        for position in positions:
+            if position >= len(parameters):
+                continue
+            media = next((m for m in medias if m["name"] == parameters[position]), None)
+            if not media:
+                return None
+            inputs.append(media)
+        if not inputs:
+            return None
+        args = tuple(evaluate(parameters[i]) for i in range(2, len(parameters)) if i not in positions)
+        return self.step_for(inputs[0], cmd_def["name"], args, inputs[1:])
+
+    def step_for(self, media: dict, cmd_name: str, args: tuple, others: list = ()):
+        """
+        Describes a step that is not a plain script line, like a fused audio chain.
+
+        :param media: The media the step replaces.
+        :type media: dict
+        :param cmd_name: The name of the step.
+        :type cmd_name: str
+        :param args: The evaluated arguments.
+        :type args: tuple
+        :param others: Other medias the step reads.
+        :type others: list
+        :return: The step.
+        :rtype: dict
+        """
+        key = (media["token"], cmd_name, args, tuple(m["token"] for m in others))
+        return {"media": media, "key": key, "token": new_token(*key)}
+
+    def reuse(self, step: dict, medias: list) -> bool:
+        """
+        Gives the media of a step the result computed earlier for another media.
+
+        :param step: The step returned by ``step``.
+        :type step: dict
+        :param medias: The current medias.
+        :type medias: list
+        :return: Whether a result was reused.
+        :rtype: bool
+        """
+        result = self.results.get(step["key"])
+        if not result or not os.path.exists(result):
+            return False
+        media = step["media"]
+        if os.path.exists(media["file"]):
+            os.remove(media["file"])
+        link_or_copy(result, media["file"])
+        media["token"] = step["token"]
+        self.prune(medias)
+        return True
+
+    def record(self, step: dict, medias: list):
+        """
+        Updates the token of a media after its step ran, keeping the result if
+        another media may run the same step later.
+
+        :param step: The step returned by ``step``.
+        :type step: dict
+        :param medias: The current medias.
+        :type medias: list
+        """
+        media = step["media"]
+        media["token"] = step["token"]
+        input_token = step["key"][0]
+        if os.path.exists(media["file"]) and any(m["token"] == input_token for m in medias if m is not media):
+            directory, filename = os.path.split(media["file"])
+            result = os.path.join(directory, f"cse_{step['token']}{os.path.splitext(filename)[1]}")
+            if not os.path.exists(result):
+                link_or_copy(media["file"], result)
+            self.results[step["key"]] = result
+        self.prune(medias)
+
+    def relocate(self, moved: dict):
+        """Follows kept results that the workspace moved to another directory."""
+        for key, result in self.results.items():
+            if result in moved:
+                self.results[key] = moved[result]
+
+    def prune(self, medias: list):
+        """Drops kept results that no remaining media can ask for."""
+        alive = {m["token"] for m in medias}
+        for key, result in list(self.results.items()):
+            if key[0] not in alive:
+                del self.results[key]
+                try:
+                    os.remove(result)
+                except OSError:
+                    pass
@@ -0,0 +1,127 @@
+import os
+from .audio import audio_filters, video_filters
+from .cache import cache_dir
+
+# Encoder settings for each place a render ends up. "threads" caps each encode,
+# past it x264 and VP9 gain little and concurrent renders fight over the CPU.
+PROFILES = {
+    "chat-mp4": {
+        "extension": ".mp4",
+        "video": ["-c:v", "libx264", "-preset", "veryfast", "-crf", "26", "-pix_fmt", "yuv420p"],
+        "audio": ["-c:a", "aac", "-b:a", "128k"],
+        "threads": 4,
+        "faststart": True,
+    },
+    "webm-small": {
+        "extension": ".webm",
+        "video": ["-c:v", "libvpx-vp9", "-crf", "38", "-b:v", "0", "-deadline", "realtime", "-cpu-used", "8", "-row-mt", "1"],
+        "audio": ["-c:a", "libopus", "-b:a", "64k"],
+        "threads": 4,
+        "faststart": False,
+    },
+    "gif": {
+        "extension": ".gif",
+        "fps": 15,
+        "width": 480,
+        # The GIF encoder and palette filters run on one thread
+        "threads": 1,
+        "faststart": False,
+    },
+    "png": {
+        "extension": ".png",
+        "video": ["-frames:v", "1", "-update", "1", "-compression_level", "3"],
+        "audio": ["-an"],
+        "threads": 1,
+        "faststart": False,
+    },
+}
+
+# Arguments convert uses for each target extension, FFmpeg defaults for the rest
+CONVERT_ARGS = {
+    ".mp3": ["-q:a", "0"],
+    ".ogg": ["-c:a", "libvorbis", "-q:a", "5"],
+    ".wav": [],
+    ".mp4": PROFILES["chat-mp4"]["video"] + PROFILES["chat-mp4"]["audio"] + ["-movflags", "+faststart"],
+    ".mkv": ["-c:v", "libx264", "-preset", "veryfast", "-crf", "23", "-c:a", "copy"],
+    ".webm": PROFILES["webm-small"]["video"] + PROFILES["webm-small"]["audio"],
+    ".png": ["-frames:v", "1", "-update", "1"],
+    ".jpg": ["-frames:v", "1", "-update", "1", "-q:v", "2"],
+}
+
+def get_profile(name: str) -> dict:
+    """
+    Returns a render profile by name.
+
+    :param name: The profile name.
+    :type name: str
+    :return: The profile, with its name.
+    :rtype: dict
+    :raises KeyError: If there is no such profile.
+    """
+    if name not in PROFILES:
+        raise KeyError(f"Unknown render profile '{name}', expected one of {', '.join(PROFILES)}.")
+    return dict(PROFILES[name], name=name)
+
+def profile_args(profile: dict, streaming: bool = False, chain: dict = None) -> list:
+    """
+    Returns the FFmpeg arguments of a profile.
+
+    :param profile: The profile.
+    :type profile: dict
+    :param streaming: Whether the output goes to a pipe, which cannot seek back to move the index.
+    :type streaming: bool
+    :param chain: Deferred audio commands to run in the same encode.
+    :type chain: dict
+    :return: The arguments.
+    :rtype: list
+    """
+    args = []
+    if chain and video_filters(chain):
+        args += ["-vf", ",".join(video_filters(chain))]
+    if chain and audio_filters(chain) and profile.get("audio") != ["-an"]:
+        args += ["-af", ",".join(audio_filters(chain))]
+    args += profile.get("video", []) + profile.get("audio", []) + ["-threads", str(profile["threads"])]
+    if profile["faststart"] and not streaming:
+        args += ["-movflags", "+faststart"]
+    return args
+
+def palette_path(token: str, profile: dict) -> str:
+    """Returns where the GIF palette of a media content is cached, in the per-user palettes cache."""
+    return os.path.join(cache_dir("palettes"), f"{token}_{profile['name']}.png")
+
+def gif_args(profile: dict, palette: str = None, save_palette: str = None, chain: dict = None) -> list:
+    """
+    Returns the FFmpeg arguments encoding a GIF in a single filter graph.
+
+    Without a palette, the graph generates one from the whole input and applies
+    it in the same run, and can also write it as a second output to be cached.
+    With a cached palette, it is read as a second input instead.
+
+    :param profile: The GIF profile.
+    :type profile: dict
+    :param palette: A cached palette to use.
+    :type palette: str
+    :param save_palette: Where to write the generated palette.
+    :type save_palette: str
+    :param chain: Deferred audio commands, a GIF only keeps their tempo change.
+    :type chain: dict
+    :return: The arguments, placed before the GIF output file.
+    :rtype: list
+    """
+    timing = (video_filters(chain, profile["fps"]) if chain else []) or [f"fps={profile['fps']}"]
+    scale = f"{','.join(timing)},scale='min({profile['width']},iw)':-1:flags=lanczos"
+    threads = ["-threads", str(profile["threads"])]
+    if palette:
+        graph = f"[0:v]{scale}[v];[v][1:v]paletteuse=dither=bayer:bayer_scale=5[out]"
+        return ["-i", palette, "-filter_complex", graph, "-map", "[out]", "-loop", "0", *threads]
+    if save_palette:
+        graph = f"[0:v]{scale},split[a][b];[a]palettegen=stats_mode=diff,split[p][saved];[b][p]paletteuse=dither=bayer:bayer_scale=5[out]"
+        return ["-filter_complex", graph, "-map", "[saved]", "-update", "1", save_palette, "-map", "[out]", "-loop", "0", *threads]
+    graph = f"[0:v]{scale},split[a][b];[a]palettegen=stats_mode=diff[p];[b][p]paletteuse=dither=bayer:bayer_scale=5[out]"
+    return ["-filter_complex", graph, "-map", "[out]", "-loop", "0", *threads]
+
+def convert_args(extension: str) -> list:
+    """Returns the FFmpeg arguments convert uses for a target extension."""
+    if extension == ".gif":
+        return gif_args(get_profile("gif"))
+    return list(CONVERT_ARGS.get(extension, []))
@@ -0,0 +1,171 @@
+import os
+import shutil
+import tempfile
+from .planner import link_or_copy
+
+SNAPSHOT_DIR = ".snapshots"
+
+def line_key(line: str, original_dir: str, parameters: tuple = None):
+    """
+    Builds the comparison key for one script line.
+
+    ``loadfile`` lines also carry the size and modification time of the file
+    they read, so editing the source media on disk invalidates the line even
+    though its text did not change.
+
+    :param line: The script line.
+    :type line: str
+    :param original_dir: The directory relative file paths are resolved against.
+    :type original_dir: str
+    :param parameters: The compiled parameters of the line, when its text cannot be split back into them.
+    :type parameters: tuple
+    :return: The key for the line.
+    :rtype: tuple
+    """
+    parts = list(parameters) if parameters else line.split()
+    stamp = None
+    if parts[0] == "loadfile" and len(parts) > 1:
+        file_path = parts[1] if os.path.isabs(parts[1]) else os.path.join(original_dir, parts[1])
+        try:
+            stat = os.stat(file_path)
+            stamp = (stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            pass
+    return (line.strip(), stamp)
+
+class Session:
+    """
+    Keeps the workspace of the last ``parse`` run alive between calls.
+
+    Before every line a snapshot of the variables and medias is taken. The media
+    files are hard linked into the snapshot directory, which is cheap because
+    commands always write a new file and rename it over the old one instead of
+    editing in place. On the next run the script is compared line by line with
+    the previous one and execution resumes from the first line that differs.
+
+    Usage::
+
+      with Session() as session:
+        await parse(script, session=session)
+        await parse(edited_script, session=session)
+    """
+    def __init__(self):
+        self.workspace = tempfile.mkdtemp(prefix="mediascript_session_")
+        self.snapshot_dir = os.path.join(self.workspace, SNAPSHOT_DIR)
+        os.mkdir(self.snapshot_dir)
+        self.keys = []
+        self.snapshots = {}
+
+    def resume_point(self, keys: list, evaluate=None) -> int:
+        """
+        Finds the index of the first line that has to be executed again.
+
+        A ``set`` line whose text changed but that evaluates to the same variable
+        state as before is not treated as a divergence.
+
+        :param keys: The keys of the new script, as built by ``line_key``.
+        :type keys: list
+        :param evaluate: Called with a line and the variables before it. Returns
+          the variables after the line, or None if the line is not a ``set``.
+        :type evaluate: callable
+        :return: The index to resume from.
+        :rtype: int
+        """
+        if not self.snapshots:
+            return 0
+        limit = min(max(self.snapshots), len(keys))
+        index = 0
+        while index < limit:
+            if index >= len(self.keys) or keys[index] != self.keys[index]:
+                if evaluate is None or index + 1 not in self.snapshots:
+                    break
+                before = self.snapshots[index]["variables"]
+                after = evaluate(keys[index][0], dict(before))
+                if after is None or after != self.snapshots[index + 1]["variables"]:
+                    break
+            index += 1
+        return index
+
+    def record(self, index: int, variables: dict, medias: list):
+        """
+        Stores the state before the line at index.
+
+        :param index: The index of the line about to run.
+        :type index: int
+        :param variables: The current variables.
+        :type variables: dict
+        :param medias: The current medias.
+        :type medias: list
+        """
+        self._drop(index)
+        snapshot_medias = []
+        for position, media in enumerate(medias):
+            media = dict(media)
+            media["snapshot"] = None
+            media_file = os.path.join(self.workspace, media["file"])
+            if os.path.exists(media_file):
+                snapshot_file = os.path.join(self.snapshot_dir, f"{index}_{position}_{os.path.basename(media['file'])}")
+                link_or_copy(media_file, snapshot_file)
+                media["snapshot"] = snapshot_file
+            snapshot_medias.append(media)
+        self.snapshots[index] = {"variables": dict(variables), "medias": snapshot_medias}
+
+    def restore(self, index: int, keys: list):
+        """
+        Restores the workspace to the state before the line at index.
+
+        Snapshots after index belong to the previous script and are discarded.
+
+        :param index: The index returned by ``resume_point``.
+        :type index: int
+        :param keys: The keys of the new script.
+        :type keys: list
+        :return: The restored variables and medias.
+        :rtype: tuple
+        """
+        for later in [i for i in self.snapshots if i > index]:
+            self._drop(later)
+        self.keys = list(keys)
+        for entry in os.listdir(self.workspace):
+            if entry == SNAPSHOT_DIR:
+                continue
+            path = os.path.join(self.workspace, entry)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+        snapshot = self.snapshots.get(index)
+        if not snapshot:
+            return {}, []
+        medias = []
+        for snapshot_media in snapshot["medias"]:
+            media = dict(snapshot_media)
+            del media["snapshot"]
+            target = os.path.join(self.workspace, media["file"])
+            if snapshot_media["snapshot"] and not os.path.exists(target):
+                link_or_copy(snapshot_media["snapshot"], target)
+            medias.append(media)
+        return dict(snapshot["variables"]), medias
+
+    def _drop(self, index: int):
+        snapshot = self.snapshots.pop(index, None)
+        if not snapshot:
+            return
+        for media in snapshot["medias"]:
+            if media["snapshot"]:
+                try:
+                    os.remove(media["snapshot"])
+                except OSError:
+                    pass
+
+    def close(self):
+        """Removes the workspace and every snapshot."""
+        shutil.rmtree(self.workspace, ignore_errors=True)
+        self.snapshots = {}
+        self.keys = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
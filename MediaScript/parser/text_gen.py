@@ -1,6 +1,14 @@
 from PIL import Image, ImageDraw, ImageFont
+from collections import OrderedDict
+from functools import lru_cache
+import io
 import os
 
+# Rendered images kept in memory, keyed by everything that affects the output
+RENDER_CACHE_SIZE = 64
+_render_cache = OrderedDict()
+
+@lru_cache(maxsize=None)
 def get_font_path():
     """Detects standard font paths for Termux/Android/Linux."""
     paths = [
@@ -12,20 +20,35 @@ def get_font_path():
         if os.path.exists(p): return p
     return None
 
+@lru_cache(maxsize=32)
+def load_font(font_path, font_size):
+    """Loads a TrueType font once per (path, size), falling back to the default font."""
+    try:
+        return ImageFont.truetype(font_path, font_size) if font_path else ImageFont.load_default()
+    except:
+        return ImageFont.load_default()
+
 def wrap_text_smart(text, font, max_width):
     """Wraps only at spaces. Long words are allowed to exceed max_width."""
     words = text.split(' ')
     lines = []
     current_line = []
+    current_width = 0
+    space_width = font.getlength(' ')
+    word_widths = {}
 
     for word in words:
-        test_line = ' '.join(current_line + [word])
-        # Measure pixel width of the potential line
-        if font.getlength(test_line) <= max_width or not current_line:
+        # Measure each word once and add it to the running width of the line
+        if word not in word_widths:
+            word_widths[word] = font.getlength(word)
+        test_width = current_width + space_width + word_widths[word] if current_line else word_widths[word]
+        if test_width <= max_width or not current_line:
             current_line.append(word)
+            current_width = test_width
         else:
             lines.append(' '.join(current_line))
             current_line = [word]
+            current_width = word_widths[word]
     
     if current_line:
         lines.append(' '.join(current_line))
@@ -33,11 +56,15 @@ def wrap_text_smart(text, font, max_width):
     return '\n'.join(lines)
 
 def generate_text(text, output_file="output.png", font_size=50, color="white", wrap_bounds=600, align="left"):
-    font_path = get_font_path()
-    try:
-        font = ImageFont.truetype(font_path, font_size) if font_path else ImageFont.load_default()
-    except:
-        font = ImageFont.load_default()
+    key = (text, font_size, color, wrap_bounds, align)
+    if key in _render_cache:
+        _render_cache.move_to_end(key)
+        with open(output_file, "wb") as f:
+            f.write(_render_cache[key])
+        print(f"✅ Reused {align}-aligned image: {output_file}")
+        return
+
+    font = load_font(get_font_path(), font_size)
 
     # 1. Wrap the text (Preserving long words)
     wrapped_text = wrap_text_smart(text, font, wrap_bounds)
@@ -60,6 +87,12 @@ def generate_text(text, output_file="output.png", font_size=50, color="white", w
     # The 'align' parameter handles the internal justification of the lines
     draw.multiline_text((-bbox[0] + 2, -bbox[1] + 2), wrapped_text, font=font, fill=color, align=align)
 
-    # 5. Save
-    img.save(output_file)
+    # 5. Save, keeping the encoded image for identical requests
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG")
+    _render_cache[key] = buffer.getvalue()
+    if len(_render_cache) > RENDER_CACHE_SIZE:
+        _render_cache.popitem(last=False)
+    with open(output_file, "wb") as f:
+        f.write(_render_cache[key])
     print(f"✅ Created {align}-aligned image: {output_file} ({img.size[0]}x{img.size[1]})")
\ No newline at end of file
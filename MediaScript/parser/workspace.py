@@ -0,0 +1,171 @@
+import os
+import shutil
+import tempfile
+from .planner import link_or_copy
+
+MEMORY_ROOT = "/dev/shm"
+
+class WorkspaceFullError(Exception):
+    """Exception raised when intermediates exceed the disk budget."""
+    pass
+
+def directory_usage(path: str) -> dict:
+    """
+    Returns the size of every file under path, counting hard links once.
+
+    :param path: The directory.
+    :type path: str
+    :return: The size of each file, keyed by path.
+    :rtype: dict
+    """
+    seen = set()
+    sizes = {}
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            file_path = os.path.join(dirpath, filename)
+            try:
+                stat = os.lstat(file_path)
+            except OSError:
+                continue
+            if (stat.st_dev, stat.st_ino) in seen:
+                continue
+            seen.add((stat.st_dev, stat.st_ino))
+            sizes[file_path] = stat.st_size
+    return sizes
+
+def inode_groups(path: str) -> list:
+    """
+    Groups the files under path by inode, so hard links are handled together.
+
+    :param path: The directory.
+    :type path: str
+    :return: (size, paths) for each inode.
+    :rtype: list
+    """
+    groups = {}
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            file_path = os.path.join(dirpath, filename)
+            try:
+                stat = os.lstat(file_path)
+            except OSError:
+                continue
+            group = groups.setdefault((stat.st_dev, stat.st_ino), [stat.st_size, []])
+            group[1].append(file_path)
+    return [tuple(group) for group in groups.values()]
+
+class Workspace:
+    """
+    Places the intermediates of a script and tracks how much space they use.
+
+    New intermediates go to tmpfs (``/dev/shm``) while the memory budget allows
+    and to a disk directory otherwise. Files derived from an intermediate are
+    created next to it, since commands rename their output over their input.
+    When memory use goes over budget, the largest files move to disk.
+    """
+    def __init__(self, root: str = None, memory_budget: int = 0, disk_budget: int = None):
+        """
+        :param root: An existing directory to use for disk intermediates. It is not
+          removed on close. A new temporary directory is used when not given.
+        :type root: str
+        :param memory_budget: Bytes of intermediates allowed on tmpfs. 0 disables tmpfs.
+        :type memory_budget: int
+        :param disk_budget: Bytes of intermediates allowed on disk, None for no limit.
+        :type disk_budget: int
+        """
+        self.owned = root is None
+        self.disk_dir = root or tempfile.mkdtemp(prefix="mediascript_")
+        self.memory_dir = None
+        if memory_budget and os.path.isdir(MEMORY_ROOT) and os.access(MEMORY_ROOT, os.W_OK):
+            self.memory_dir = tempfile.mkdtemp(prefix="mediascript_", dir=MEMORY_ROOT)
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.memory_bytes = 0
+        self.disk_bytes = 0
+        self.peak_memory_bytes = 0
+        self.peak_disk_bytes = 0
+        self.peak_bytes = 0
+
+    def path(self, filename: str, size_hint: int = 0) -> str:
+        """
+        Returns the absolute path for a new intermediate.
+
+        :param filename: The file name.
+        :type filename: str
+        :param size_hint: The expected size of the file, in bytes.
+        :type size_hint: int
+        :return: The path.
+        :rtype: str
+        """
+        if self.memory_dir and self.memory_bytes + size_hint <= self.memory_budget:
+            self.memory_bytes += size_hint
+            return os.path.join(self.memory_dir, filename)
+        return os.path.join(self.disk_dir, filename)
+
+    def sibling(self, path: str, filename: str) -> str:
+        """Returns a path next to an existing intermediate, so it can be renamed over it."""
+        return os.path.join(os.path.dirname(path), filename)
+
+    def derived(self, prefix: str, path: str) -> str:
+        """Returns the output path of a command reading path, like ``invert_<file>``."""
+        return self.sibling(path, f"{prefix}_{os.path.basename(path)}")
+
+    def release(self, path: str):
+        """Deletes an intermediate nothing reads anymore."""
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def settle(self, medias: list) -> dict:
+        """
+        Measures usage after a step, spilling tmpfs files to disk when over budget.
+
+        :param medias: The current medias, updated when their file moves.
+        :type medias: list
+        :return: The moved files, old path to new path.
+        :rtype: dict
+        :raises WorkspaceFullError: If the disk budget is exceeded.
+        """
+        moved = {}
+        memory = inode_groups(self.memory_dir) if self.memory_dir else []
+        self.memory_bytes = sum(size for size, _ in memory)
+        if self.memory_bytes > self.memory_budget:
+            for size, paths in sorted(memory, key=lambda group: group[0], reverse=True):
+                if self.memory_bytes <= self.memory_budget:
+                    break
+                # Every link of the inode moves, otherwise tmpfs keeps it and disk gets a second copy
+                first = os.path.join(self.disk_dir, os.path.basename(paths[0]))
+                shutil.move(paths[0], first)
+                moved[paths[0]] = first
+                for path in paths[1:]:
+                    destination = os.path.join(self.disk_dir, os.path.basename(path))
+                    link_or_copy(first, destination)
+                    os.remove(path)
+                    moved[path] = destination
+                self.memory_bytes -= size
+            for media in medias:
+                if media["file"] in moved:
+                    media["file"] = moved[media["file"]]
+        self.disk_bytes = sum(directory_usage(self.disk_dir).values())
+        self.peak_memory_bytes = max(self.peak_memory_bytes, self.memory_bytes)
+        self.peak_disk_bytes = max(self.peak_disk_bytes, self.disk_bytes)
+        self.peak_bytes = max(self.peak_bytes, self.memory_bytes + self.disk_bytes)
+        if self.disk_budget is not None and self.disk_bytes > self.disk_budget:
+            raise WorkspaceFullError(f"Intermediates use {self.disk_bytes} bytes of disk, over the budget of {self.disk_budget}.")
+        return moved
+
+    def report(self) -> dict:
+        """Returns the peak usage of the workspace."""
+        return {
+            "peak_bytes": self.peak_bytes,
+            "peak_memory_bytes": self.peak_memory_bytes,
+            "peak_disk_bytes": self.peak_disk_bytes,
+        }
+
+    def close(self):
+        """Removes every intermediate."""
+        if self.memory_dir:
+            shutil.rmtree(self.memory_dir, ignore_errors=True)
+        if self.owned:
+            shutil.rmtree(self.disk_dir, ignore_errors=True)
@@ -0,0 +1,187 @@
+import argparse
+import asyncio
+import base64
+import hmac
+import ipaddress
+import json
+import os
+from .parser.parse import parse, load_commands
+from .parser.text_gen import get_font_path
+
+class Server:
+    """
+    Runs scripts for clients of a long-lived process.
+
+    Clients send one JSON request per line and get JSON events back, one per
+    line. The command registry, compiled scripts, probe results, hue LUTs,
+    fonts and rendered text stay cached between requests, so a request pays
+    only for the FFmpeg work it needs.
+
+    A request is ``{"id", "token", "script", "inputs", "output", "destination"}``:
+
+    - ``token`` must match the server's token when it has one.
+    - ``inputs`` maps media names to files, loaded before the script runs.
+    - ``output`` is "files" (default), "bytes" or "stream". Bytes and stream
+      chunks are sent base64 encoded.
+    - ``destination`` is a path under the output root, where files land.
+    - ``{"op": "ping"}`` returns the server state instead of running anything.
+
+    Scripts read and write files as the server user, so a server reachable
+    beyond loopback needs a token.
+
+    The server answers with ``progress`` events, then ``chunk`` events when
+    streaming, then a ``result`` or an ``error``. Every event carries the id
+    of its request, and requests on one connection run at the same time.
+    """
+    def __init__(self, jobs: int = None, token: str = None, output_root: str = None):
+        """
+        :param jobs: How many scripts run at once, the number of CPUs when not given.
+        :type jobs: int
+        :param token: The secret every request must carry, None to accept any request.
+        :type token: str
+        :param output_root: The directory rendered files go to, the working directory when not given.
+        :type output_root: str
+        """
+        self.jobs = jobs or os.cpu_count() or 1
+        self.token = token
+        self.output_root = os.path.realpath(output_root or os.getcwd())
+        self.running = 0
+        self.served = 0
+        self._jobs = asyncio.Semaphore(self.jobs)
+
+    def warm(self):
+        """Loads the caches every request needs before the first one arrives."""
+        load_commands()
+        get_font_path()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Reads requests from a connection until it closes."""
+        def send(event: dict):
+            if not writer.is_closing():
+                writer.write((json.dumps(event) + "\n").encode())
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                except ValueError as e:
+                    send({"event": "error", "error": f"Invalid request: {e}"})
+                    continue
+                task = asyncio.create_task(self.run(request, send, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+        except ConnectionError:
+            for task in tasks:
+                task.cancel()
+        finally:
+            writer.close()
+
+    def destination(self, path: str = None) -> str:
+        """
+        Resolves the destination of a request inside the output root.
+
+        :raises ValueError: If the destination is outside the output root.
+        """
+        if not path:
+            return self.output_root
+        resolved = os.path.realpath(os.path.join(self.output_root, path))
+        if os.path.commonpath([resolved, self.output_root]) != self.output_root:
+            raise ValueError(f"Destination '{path}' is outside the output root.")
+        return resolved
+
+    async def run(self, request: dict, send, writer: asyncio.StreamWriter):
+        """Runs one request, sending its events."""
+        request_id = request.get("id")
+        try:
+            if self.token and not hmac.compare_digest(str(request.get("token", "")), self.token):
+                raise PermissionError("Invalid token")
+            if request.get("op") == "ping":
+                send({"id": request_id, "event": "pong", "running": self.running, "served": self.served, "jobs": self.jobs})
+                return
+            output = request.get("output", "files")
+            if output not in ("files", "bytes", "stream"):
+                raise ValueError(f"Unknown output '{output}', expected files, bytes or stream.")
+            destination = self.destination(request.get("destination"))
+            def progress(event: dict):
+                send(dict(event, id=request_id, event="progress"))
+            async with self._jobs:
+                self.running += 1
+                try:
+                    # Inputs are loaded first, under the names the script uses
+                    results = await parse(request["script"], output=output, destination=destination, progress=progress, inputs=request.get("inputs"))
+                    attachments = []
+                    for attachment in results["attachments"]:
+                        if output == "files":
+                            attachments.append({"name": attachment["name"], "file": attachment["file"]})
+                        elif output == "bytes":
+                            attachments.append({"name": attachment["name"], "data": base64.b64encode(attachment["data"]).decode()})
+                        else:
+                            async with attachment["stream"] as stream:
+                                async for chunk in stream:
+                                    send({"id": request_id, "event": "chunk", "name": attachment["name"], "data": base64.b64encode(chunk).decode()})
+                                    await writer.drain()
+                            attachments.append({"name": attachment["name"]})
+                finally:
+                    self.running -= 1
+                    self.served += 1
+            send({"id": request_id, "event": "result", "time": results["time"], "attachments": attachments})
+        except Exception as e:
+            send({"id": request_id, "event": "error", "error": str(e), "type": type(e).__name__})
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def serve(self, socket_path: str = None, host: str = "127.0.0.1", port: int = 7780):
+        """
+        Listens on a Unix socket, or on a TCP port when no socket path is given.
+
+        Prints ``listening <address>`` once ready.
+        """
+        self.warm()
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = await asyncio.start_unix_server(self.handle, socket_path)
+            address = socket_path
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+            address = "{} {}".format(*server.sockets[0].getsockname()[:2])
+        print(f"listening {address}", flush=True)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if socket_path and os.path.exists(socket_path):
+                os.remove(socket_path)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run MediaScript as a long-lived server.")
+    parser.add_argument("--socket", default=None, help="Unix socket path, TCP is used when not given")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7780)
+    parser.add_argument("--jobs", type=int, default=None, help="scripts run at once, the number of CPUs by default")
+    parser.add_argument("--output-root", default=None, help="directory rendered files go to, the working directory by default")
+    args = parser.parse_args()
+    # Read from the environment so the secret does not show up in the process list
+    token = os.environ.get("MEDIASCRIPT_TOKEN")
+    try:
+        loopback = args.socket is not None or args.host == "localhost" or ipaddress.ip_address(args.host).is_loopback
+    except ValueError:
+        loopback = False
+    if not loopback and not token:
+        parser.error("set MEDIASCRIPT_TOKEN to listen beyond loopback")
+    server = Server(args.jobs, token, args.output_root)
+    try:
+        asyncio.run(server.serve(args.socket, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+"""
+Benchmark harness for the MediaScript interpreter.
+
+Runs a corpus of scripts against the example videos and generated synthetic
+inputs, and records wall time, CPU time, peak RSS, peak temp-disk usage and the
+number of FFmpeg/ffprobe/ImageMagick processes spawned by each case.
+
+Usage::
+
+  python benchmarks/bench.py run --output baseline.json
+  python benchmarks/bench.py run --output current.json
+  python benchmarks/bench.py compare baseline.json current.json
+
+Each case runs in a fresh Python process so resource usage of one case does not
+leak into the next.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXAMPLE_VIDEOS = os.path.join(ROOT, "examplevideos")
+
+# Scripts run against every input of their kind. {input} is replaced by the input path.
+SCRIPTS = {
+  "gm74": ("video", """loadfile {input} m
+contrast m -1
+explode m
+copy m a
+copy m a2
+audiopitch m 0.5
+audiopitch a 1.4983070768766815
+audiopitch a2 2
+overlay m a 0 0
+volume m 0.5
+overlay m a2 0 0
+volume m 0.5
+audiopitch m 1.122462048309373
+render m gm74"""),
+  "image_only": ("image", """loadfile {input} img
+brightness img 0.1
+contrast img 1.5
+invert img
+flip img
+blur img 2
+render img output"""),
+  "audio_only": ("audio", """loadfile {input} snd
+audiopitch snd 1.5
+volume snd 0.8
+speed snd 1.25
+volume snd 1.2
+render snd output"""),
+  "geq_heavy": ("video", """loadfile {input} m
+swirl m 90
+explode m 1
+render m output"""),
+  "clone_heavy": ("video", """loadfile {input} m
+clone m a
+clone m b
+clone m c
+invert a
+invert b
+invert c
+contrast a 1.5
+contrast b 1.5
+contrast c 1.5
+overlay m a 0 0
+overlay m b 0 0
+overlay m c 0 0
+render m output"""),
+  "long_chain": ("video", """loadfile {input} m
+invert m
+flip m
+flop m
+contrast m 1.2
+brightness m 0.05
+blur m 1
+haah m
+woow m
+invert m
+darken m 0.05
+audiopitch m 1.1
+volume m 0.9
+render m output"""),
+}
+
+# Synthetic inputs generated with FFmpeg's lavfi sources: (kind, filename, ffmpeg args)
+SYNTHETIC_INPUTS = [
+  ("video", "synthetic_240p_2s.mp4", ["-f", "lavfi", "-i", "testsrc2=size=320x240:rate=30:duration=2", "-f", "lavfi", "-i", "sine=frequency=440:duration=2", "-shortest", "-pix_fmt", "yuv420p"]),
+  ("video", "synthetic_720p_5s.mp4", ["-f", "lavfi", "-i", "testsrc2=size=1280x720:rate=30:duration=5", "-f", "lavfi", "-i", "sine=frequency=440:duration=5", "-shortest", "-pix_fmt", "yuv420p"]),
+  ("video", "synthetic_1080p_10s.mp4", ["-f", "lavfi", "-i", "testsrc2=size=1920x1080:rate=30:duration=10", "-f", "lavfi", "-i", "sine=frequency=440:duration=10", "-shortest", "-pix_fmt", "yuv420p"]),
+  ("image", "synthetic_720p.png", ["-f", "lavfi", "-i", "testsrc2=size=1280x720", "-frames:v", "1"]),
+  ("image", "synthetic_4k.png", ["-f", "lavfi", "-i", "testsrc2=size=3840x2160", "-frames:v", "1"]),
+  ("audio", "synthetic_10s.wav", ["-f", "lavfi", "-i", "sine=frequency=440:duration=10"]),
+  ("audio", "synthetic_60s.wav", ["-f", "lavfi", "-i", "sine=frequency=440:duration=60"]),
+]
+
+# Relative increase of a metric over the baseline that counts as a regression
+THRESHOLDS = {
+  "wall_time": 0.10,
+  "cpu_time": 0.10,
+  "peak_rss_kb": 0.20,
+  "peak_disk_bytes": 0.20,
+  "spawns": 0.0,
+}
+
+def generate_inputs(directory: str) -> list:
+    """
+    Returns every benchmark input as (kind, path), generating the synthetic ones if needed.
+
+    :param directory: Where synthetic inputs are cached.
+    :type directory: str
+    """
+    os.makedirs(directory, exist_ok=True)
+    inputs = [
+        ("video", os.path.join(EXAMPLE_VIDEOS, "kc.mov")),
+        ("video", os.path.join(EXAMPLE_VIDEOS, "whatifjax.mp4")),
+    ]
+    for kind, filename, args in SYNTHETIC_INPUTS:
+        path = os.path.join(directory, filename)
+        if not os.path.exists(path):
+            subprocess.run(["ffmpeg", "-y", "-v", "error", *args, path], check=True)
+        inputs.append((kind, path))
+    return inputs
+
+def directory_size(path: str) -> int:
+    """Returns the bytes used by the files under path, counting hard links once."""
+    seen = set()
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                stat = os.lstat(os.path.join(dirpath, filename))
+            except OSError:
+                continue
+            if (stat.st_dev, stat.st_ino) not in seen:
+                seen.add((stat.st_dev, stat.st_ino))
+                total += stat.st_size
+    return total
+
+def run_case(script: str, result_file: str):
+    """
+    Runs one script in this process and writes its metrics to result_file.
+
+    Must run in a fresh process, peak RSS of children is only reported as a
+    maximum over the whole process lifetime.
+    """
+    sys.path.insert(0, ROOT)
+    from MediaScript import parse
+
+    spawns = {}
+    create_subprocess_exec = asyncio.create_subprocess_exec
+    async def counting_exec(program, *args, **kwargs):
+        spawns[program] = spawns.get(program, 0) + 1
+        return await create_subprocess_exec(program, *args, **kwargs)
+    asyncio.create_subprocess_exec = counting_exec
+
+    # Intermediates go to a private temp dir so its size can be sampled
+    workdir = tempfile.mkdtemp(prefix="mediascript_bench_")
+    tempfile.tempdir = workdir
+    peak_disk = [0]
+    stop = threading.Event()
+    def sample_disk():
+        while not stop.is_set():
+            peak_disk[0] = max(peak_disk[0], directory_size(workdir))
+            stop.wait(0.05)
+    sampler = threading.Thread(target=sample_disk, daemon=True)
+
+    outdir = tempfile.mkdtemp(prefix="mediascript_bench_out_")
+    cwd = os.getcwd()
+    os.chdir(outdir)
+    before = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    sampler.start()
+    start = time.perf_counter()
+    error = None
+    try:
+        asyncio.run(parse(script))
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    wall_time = time.perf_counter() - start
+    stop.set()
+    sampler.join()
+    after = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    os.chdir(cwd)
+    shutil.rmtree(outdir, ignore_errors=True)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    cpu_time = sum((a.ru_utime + a.ru_stime) - (b.ru_utime + b.ru_stime) for a, b in zip(after, before))
+    with open(result_file, "w") as f:
+        json.dump({
+            "wall_time": wall_time,
+            "cpu_time": cpu_time,
+            "peak_rss_kb": max(after[0].ru_maxrss, after[1].ru_maxrss),
+            "peak_disk_bytes": peak_disk[0],
+            "spawns": sum(spawns.values()),
+            "spawns_by_program": spawns,
+            "error": error,
+        }, f)
+
+def run_suite(output: str, repeat: int, only: list):
+    """Runs every case repeat times in a fresh process and writes the medians to output."""
+    inputs = generate_inputs(os.path.join(tempfile.gettempdir(), "mediascript_bench_inputs"))
+    results = {}
+    for script_name, (kind, template) in SCRIPTS.items():
+        if only and script_name not in only:
+            continue
+        for input_kind, input_path in inputs:
+            if input_kind != kind:
+                continue
+            case = f"{script_name}/{os.path.basename(input_path)}"
+            script = template.format(input=input_path)
+            runs = []
+            for _ in range(repeat):
+                fd, result_file = tempfile.mkstemp(suffix=".json")
+                os.close(fd)
+                subprocess.run([sys.executable, os.path.abspath(__file__), "_case", result_file], input=script, text=True, stdout=subprocess.DEVNULL, check=True)
+                with open(result_file) as f:
+                    runs.append(json.load(f))
+                os.remove(result_file)
+            result = {metric: statistics.median(run[metric] for run in runs) for metric in THRESHOLDS}
+            result["spawns_by_program"] = runs[-1]["spawns_by_program"]
+            result["error"] = next((run["error"] for run in runs if run["error"]), None)
+            results[case] = result
+            print(f"{case}: {result['wall_time']:.2f}s wall, {result['cpu_time']:.2f}s cpu, {result['spawns']} spawns" + (f" ({result['error']})" if result["error"] else ""))
+    ffmpeg_version = subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True).stdout.split("\n")[0]
+    with open(output, "w") as f:
+        json.dump({
+            "meta": {"python": platform.python_version(), "platform": platform.platform(), "ffmpeg": ffmpeg_version, "repeat": repeat},
+            "results": results,
+        }, f, indent=2)
+
+def compare(baseline_file: str, current_file: str) -> bool:
+    """
+    Prints every metric that regressed past its threshold.
+
+    :return: Whether any regression was found.
+    :rtype: bool
+    """
+    with open(baseline_file) as f:
+        baseline = json.load(f)["results"]
+    with open(current_file) as f:
+        current = json.load(f)["results"]
+    regressed = False
+    for case, result in current.items():
+        if case not in baseline:
+            print(f"{case}: new case")
+            continue
+        if result["error"] and not baseline[case]["error"]:
+            print(f"{case}: REGRESSION now fails with {result['error']}")
+            regressed = True
+        for metric, threshold in THRESHOLDS.items():
+            old, new = baseline[case][metric], result[metric]
+            change = (new - old) / old if old else (1.0 if new > old else 0.0)
+            flag = ""
+            if change > threshold:
+                flag = "  REGRESSION"
+                regressed = True
+            print(f"{case} {metric}: {old:.4g} -> {new:.4g} ({change:+.1%}){flag}")
+    return regressed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="Run the benchmark corpus.")
+    run.add_argument("--output", default="bench_output.json")
+    run.add_argument("--repeat", type=int, default=3)
+    run.add_argument("--only", nargs="*", default=[], help="Script names to run.")
+    diff = commands.add_parser("compare", help="Flag regressions against a baseline.")
+    diff.add_argument("baseline")
+    diff.add_argument("current")
+    case = commands.add_parser("_case")
+    case.add_argument("result_file")
+    args = parser.parse_args()
+    if args.command == "run":
+        run_suite(args.output, args.repeat, args.only)
+    elif args.command == "compare":
+        sys.exit(1 if compare(args.baseline, args.current) else 0)
+    else:
+        run_case(sys.stdin.read(), args.result_file)
+
+if __name__ == "__main__":
+    main()